@@ -15,11 +15,13 @@ zip -x ./src/refining_specific* -x ./src/refining_global* -r tools.zip ./src/
 #sleep 60s
 
 echo "Spark submit:"
+# Keep the Spark job properties (scheduler pool, job group) of each python thread, used by the sharded mode
+export PYSPARK_PIN_THREAD=true
 spark-submit \
     --deploy-mode client \
     --master yarn \
     --py-files tools.zip \
-    ./src/refining_global/main_data_refining_global.py -c $technical_conf_file
+    ./src/refining_global/main_data_refining_global.py -c $technical_conf_file "${@:2}"
 
 echo $? > code_status
 my_exit_code=$(cat code_status)
@@ -0,0 +1,184 @@
+from datetime import date, datetime, timedelta
+
+import src.tools.utils as ut
+
+import pyspark.sql.functions as F
+from pyspark.sql import Window
+
+
+# A sunday, first day of a week: the week ordinals count the weeks since this day
+REFERENCE_FIRST_DAY = date(2000, 1, 2)
+
+
+def get_week_ordinal(week_id):
+    """
+    Get the ordinal of a week id, so that consecutive weeks have consecutive ordinals
+
+    Args:
+        week_id: (int) week id
+
+    Returns:
+        object: (int) number of weeks since the reference week
+    """
+    # ISO weeks begin on monday, Decathlon weeks the sunday before
+    first_day = datetime.strptime(str(week_id) + '1', '%G%V%u').date() - timedelta(days=1)
+    return (first_day - REFERENCE_FIRST_DAY).days // 7
+
+
+def get_sales_statistics(model_week_sales, last_week_ordinal, anomaly_params):
+    """
+    Compute the rolling statistics of each (model, channel) in one pass over a single window, on the weeks
+    needed by the checked weeks only. The weeks without sales have no row: they count as 0 in the statistics.
+        - rolling_mean & rolling_std: sales of the lookback weeks before the week
+        - active_weeks: number of weeks with sales among the lookback weeks up to the week (included)
+        - is_last_sale: no sales after the week
+
+    Args:
+        model_week_sales: (SparkDataframe) model_id, week_id, date, channel, sales_quantity
+        last_week_ordinal: (int) ordinal of the last week of the sales
+        anomaly_params: (dict) anomaly detection parameters
+
+    Returns:
+        (SparkDataframe): the sales of the checked weeks with their statistics
+    """
+    lookback = anomaly_params['lookback_weeks']
+    first_checked_ordinal = last_week_ordinal - anomaly_params['check_weeks'] + 1
+
+    timeline = Window.partitionBy('model_id', 'channel').orderBy('week_ordinal')
+    before = timeline.rangeBetween(-lookback, -1)
+    up_to = timeline.rangeBetween(-lookback + 1, 0)
+    quantity = F.col('sales_quantity').cast('double')
+
+    sales_statistics = model_week_sales \
+        .select('model_id', 'week_id', 'channel', 'sales_quantity',
+                F.floor(F.datediff(F.col('date'), F.lit(REFERENCE_FIRST_DAY.isoformat())) / 7).cast('int')
+                .alias('week_ordinal')) \
+        .filter(F.col('week_ordinal') >= first_checked_ordinal - lookback) \
+        .withColumn('rolling_sum', F.coalesce(F.sum(quantity).over(before), F.lit(0.0))) \
+        .withColumn('rolling_sum_sq', F.coalesce(F.sum(quantity * quantity).over(before), F.lit(0.0))) \
+        .withColumn('active_weeks', F.count(quantity).over(up_to)) \
+        .withColumn('is_last_sale', F.lead('week_ordinal').over(timeline).isNull()) \
+        .withColumn('rolling_mean', F.col('rolling_sum') / lookback) \
+        .withColumn('rolling_std', F.sqrt(F.greatest(F.col('rolling_sum_sq') / lookback -
+                                                     F.col('rolling_mean') * F.col('rolling_mean'), F.lit(0.0)))) \
+        .withColumn('is_checked', F.col('week_ordinal') >= first_checked_ordinal) \
+        .drop('rolling_sum', 'rolling_sum_sq')
+    return sales_statistics
+
+
+def get_anomalies(sales_statistics, last_week_ordinal, anomaly_params):
+    """
+    Flag the anomalies of the checked weeks:
+        - 'spike': sales far from the rolling mean of a regularly sold model, the score being the deviation in
+          rolling standard deviations (at least the Poisson one, the square root of the mean)
+        - 'drop_to_zero': a regularly sold model without any sales since a checked week, the score being the
+          number of weeks without sales
+
+    Args:
+        sales_statistics: (SparkDataframe) output of get_sales_statistics
+        last_week_ordinal: (int) ordinal of the last week of the sales
+        anomaly_params: (dict) anomaly detection parameters
+
+    Returns:
+        (SparkDataframe): model_id, channel, week_id, anomaly_type, sales_quantity, rolling_mean, score
+    """
+    is_regular = F.col('active_weeks') >= anomaly_params['min_active_weeks']
+    spike_score = (F.col('sales_quantity') - F.col('rolling_mean')) / \
+        F.greatest(F.col('rolling_std'), F.sqrt(F.col('rolling_mean')))
+    spikes = sales_statistics \
+        .filter(F.col('is_checked') & is_regular & (F.col('rolling_mean') >= anomaly_params['min_rolling_mean'])) \
+        .withColumn('score', spike_score) \
+        .filter(F.abs(F.col('score')) > anomaly_params['zscore_threshold']) \
+        .withColumn('anomaly_type', F.lit('spike'))
+    # A model still sold in the last week is not a drop, even if not sold in the previous weeks
+    drops = sales_statistics \
+        .filter(F.col('is_last_sale') & is_regular &
+                (F.col('week_ordinal') < last_week_ordinal) &
+                (F.col('week_ordinal') >= last_week_ordinal - anomaly_params['check_weeks'])) \
+        .withColumn('score', (F.lit(last_week_ordinal) - F.col('week_ordinal')).cast('double')) \
+        .withColumn('anomaly_type', F.lit('drop_to_zero'))
+
+    columns = ['model_id', 'channel', 'week_id', 'anomaly_type', 'sales_quantity', 'rolling_mean', 'score']
+    return spikes.select(columns).union(drops.select(columns))
+
+
+def get_anomaly_summary(sales_statistics, anomalies):
+    """
+    Aggregate the anomalies by channel, relatively to the number of models sold in the period
+
+    Args:
+        sales_statistics: (SparkDataframe) output of get_sales_statistics
+        anomalies: (SparkDataframe) output of get_anomalies
+
+    Returns:
+        object: (dict) channel -> {'nb_models', 'nb_checked_sales', 'nb_spikes', 'nb_drops', 'spike_ratio',
+                'drop_ratio'}
+    """
+    models = sales_statistics \
+        .groupBy('channel') \
+        .agg(F.countDistinct('model_id').alias('nb_models'),
+             F.sum(F.col('is_checked').cast('int')).alias('nb_checked_sales')) \
+        .collect()
+    counts = anomalies \
+        .groupBy('channel') \
+        .agg(F.sum((F.col('anomaly_type') == 'spike').cast('int')).alias('nb_spikes'),
+             F.sum((F.col('anomaly_type') == 'drop_to_zero').cast('int')).alias('nb_drops')) \
+        .collect()
+    counts = {c['channel']: c for c in counts}
+
+    summary = {}
+    for m in models:
+        nb_spikes = counts[m['channel']]['nb_spikes'] if m['channel'] in counts else 0
+        nb_drops = counts[m['channel']]['nb_drops'] if m['channel'] in counts else 0
+        summary[m['channel']] = {
+            'nb_models': m['nb_models'],
+            'nb_checked_sales': m['nb_checked_sales'],
+            'nb_spikes': nb_spikes,
+            'nb_drops': nb_drops,
+            'spike_ratio': round(nb_spikes / max(m['nb_checked_sales'], 1), 4),
+            'drop_ratio': round(nb_drops / max(m['nb_models'], 1), 4),
+        }
+    return summary
+
+
+def detect_sales_anomalies(model_week_sales, current_week, bucket, path_refined_global, anomaly_params):
+    """
+    Flag the per (model, channel) anomalies of the last weeks, write them in model_week_sales_anomaly,
+    and fail if the share of spikes or drops of a channel is above its threshold (e.g. all the models of a
+    channel dropping to zero after a change of join key). The anomalies are written before failing,
+    to be investigated.
+
+    Args:
+        model_week_sales: (SparkDataframe) model_id, week_id, date, channel, sales_quantity
+        current_week: (int) current week id
+        bucket: (string) refined S3 bucket
+        path_refined_global: (string) prefix of the refined tables
+        anomaly_params: (dict) anomaly detection parameters
+
+    Returns:
+        object: (dict) summary by channel
+    """
+    last_week_ordinal = get_week_ordinal(ut.get_shift_n_week(current_week, -1))
+    sales_statistics = get_sales_statistics(model_week_sales, last_week_ordinal, anomaly_params).cache()
+    anomalies = get_anomalies(sales_statistics, last_week_ordinal, anomaly_params).cache()
+    ut.spark_write_parquet_s3(anomalies, bucket, path_refined_global + 'model_week_sales_anomaly', repartition=1)
+
+    summary = get_anomaly_summary(sales_statistics, anomalies)
+    sales_statistics.unpersist()
+    anomalies.unpersist()
+    for channel, channel_summary in sorted(summary.items()):
+        print('[anomalies] {}: {}'.format(channel, channel_summary))
+
+    # A channel without any sales in the period (e.g. all its history lost) has no summary
+    for channel in anomaly_params['expected_channels'] or []:
+        assert channel in summary, '---> ALERT: no sales of channel {} in the last weeks'.format(channel)
+    for channel, channel_summary in sorted(summary.items()):
+        if anomaly_params['max_spike_ratio'] is not None:
+            assert channel_summary['spike_ratio'] <= anomaly_params['max_spike_ratio'], \
+                '---> ALERT: {} spikes for {} sales of channel {}'.format(
+                    channel_summary['nb_spikes'], channel_summary['nb_checked_sales'], channel)
+        if anomaly_params['max_drop_ratio'] is not None:
+            assert channel_summary['drop_ratio'] <= anomaly_params['max_drop_ratio'], \
+                '---> ALERT: {} models of {} dropped to zero sales in channel {}'.format(
+                    channel_summary['nb_drops'], channel_summary['nb_models'], channel)
+    return summary
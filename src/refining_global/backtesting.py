@@ -0,0 +1,114 @@
+import pyspark.sql.functions as F
+from pyspark.sql.types import IntegerType, StructField, StructType
+
+import src.tools.utils as ut
+import src.tools.storage as storage
+
+import model_week_tree as tree
+
+
+def parse_cutoffs(backtest_cutoffs, first_historical_week, current_week):
+    """
+    Parse & check the backtesting cutoffs
+
+    Args:
+        backtest_cutoffs: (string) comma separated week ids
+        first_historical_week: (int) first week of the history
+        current_week: (int) current week id
+
+    Returns:
+        object: (list) sorted cutoff week ids
+    """
+    cutoffs = sorted(set([int(c) for c in backtest_cutoffs.split(',')]))
+    for cutoff in cutoffs:
+        if not first_historical_week < cutoff <= current_week:
+            raise Exception("Backtesting cutoff {} must be after {} and up to the current week {}"
+                            .format(cutoff, first_historical_week, current_week))
+    return cutoffs
+
+
+def get_cutoffs(spark, cutoffs):
+    schema = StructType([StructField('cutoff', IntegerType(), False)])
+    return F.broadcast(spark.createDataFrame([(c,) for c in cutoffs], schema))
+
+
+def get_backtest_tables(spark, cutoffs, model_week_sales, model_tree_history, model_week_mrp, week,
+                        first_backtesting_cutoff, write_model_week_tree):
+    """
+    Derive the refined tables as they would have been computed at each cutoff, from the tables computed once
+    up to the current week. A run at a cutoff c filters the days & weeks up to c (included) and keeps the sales
+    before c, so each snapshot is a filter of the current tables on week_id, followed by the reduction to the
+    models sold before c. All the cutoffs are derived at once with a join on the (small, broadcasted) cutoffs.
+
+    Args:
+        spark: (SparkSession) spark app
+        cutoffs: (list) cutoff week ids
+        model_week_sales: (SparkDataframe) sales, price & turnover of the current week
+        model_tree_history: (SparkDataframe) model tree history of the current week, not reduced
+        model_week_mrp: (SparkDataframe) model week MRP of the current week, not reduced
+        week: (SparkDataframe) filtered weeks
+        first_backtesting_cutoff: (int) first week of the tree & MRP
+        write_model_week_tree: (bool) add the model tree expanded week by week
+
+    Returns:
+        object: (dict) table name -> table with a 'cutoff' column
+    """
+    df_cutoffs = get_cutoffs(spark, cutoffs)
+
+    backtest_sales = model_week_sales \
+        .join(df_cutoffs, on=model_week_sales['week_id'] < df_cutoffs['cutoff'], how='inner')
+    l_model_id = backtest_sales.select('cutoff', 'model_id').drop_duplicates()
+
+    backtest_tree_history = model_tree_history \
+        .join(df_cutoffs, on=model_tree_history['valid_from_week'] <= df_cutoffs['cutoff'], how='inner') \
+        .withColumn('valid_to_week', F.least(F.col('valid_to_week'), F.col('cutoff'))) \
+        .join(l_model_id, on=['cutoff', 'model_id'], how='inner')
+
+    backtest_mrp = model_week_mrp \
+        .join(df_cutoffs, on=model_week_mrp['week_id'] <= df_cutoffs['cutoff'], how='inner') \
+        .join(l_model_id, on=['cutoff', 'model_id'], how='inner')
+
+    keys = ['cutoff', 'model_id', 'week_id', 'date', 'channel']
+    backtest_tables = {
+        'model_week_sales': backtest_sales.select(keys + ['sales_quantity']),
+        'model_week_price': backtest_sales.select(keys + ['average_price']),
+        'model_week_turnover': backtest_sales.select(keys + ['sum_turnover']),
+        'model_tree_history': backtest_tree_history,
+        'model_week_mrp': backtest_mrp,
+    }
+    if write_model_week_tree:
+        model_week_tree = tree.expand_model_tree_history(model_tree_history, week, first_backtesting_cutoff)
+        backtest_tables['model_week_tree'] = model_week_tree \
+            .join(df_cutoffs, on=model_week_tree['week_id'] <= df_cutoffs['cutoff'], how='inner') \
+            .join(l_model_id, on=['cutoff', 'model_id'], how='inner')
+    return backtest_tables
+
+
+def write_backtest_table(spark, df, cutoffs, bucket, path, nb_partitions, sort_by, row_group_mb):
+    """
+    Write a backtesting table in its cutoff partitions, only overwriting the partitions of the given cutoffs.
+    The rows of each cutoff are range partitioned on model_id, so that a cutoff is written by many tasks.
+    The S3A commit protocol (PathOutputCommitProtocol) does not support the dynamic partition overwrite:
+    with the s3a scheme, each cutoff partition is overwritten explicitly instead.
+
+    Args:
+        spark: (SparkSession) spark app
+        df: (SparkDataframe) backtesting table with a 'cutoff' column
+        cutoffs: (list) cutoff week ids
+        bucket: (string) refined S3 bucket
+        path: (string) full path to the backtesting table within the S3 bucket
+        nb_partitions: (int) number of files written for all the cutoffs
+        sort_by: (list) columns sorting the rows of each file
+        row_group_mb: (int) size of the parquet row groups
+    """
+    if storage.get_storage().scheme != 's3a':
+        spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+        ut.spark_write_parquet_s3(df, bucket, path, nb_partitions, partition_by=['cutoff'], sort_by=sort_by,
+                                  row_group_mb=row_group_mb, range_by=['model_id'])
+        spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'static')
+        return
+    # The filter on the cutoff goes through the join with the broadcasted cutoffs: only this cutoff is derived
+    for cutoff in cutoffs:
+        ut.spark_write_parquet_s3(df.filter(F.col('cutoff') == cutoff).drop('cutoff'), bucket,
+                                  path + '/cutoff={}'.format(cutoff), max(1, nb_partitions // len(cutoffs)),
+                                  sort_by=sort_by, row_group_mb=row_group_mb, range_by=['model_id'])
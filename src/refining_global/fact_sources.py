@@ -0,0 +1,183 @@
+from collections import OrderedDict
+from functools import reduce
+
+import pyspark.sql.functions as F
+
+
+# Common narrow schema of the sales lines of every channel, before any join
+FACT_COLUMNS = ['sku_idr_sku', 'tdt_date_to_ordered', 'but_idr_business_unit', 'f_qty_item',
+                'f_pri_regular_sales_unit', 'f_to_tax_in', 'cur_idr_currency']
+
+# Dimensions joined once on the union of the channels
+SHARED_DIMENSIONS = ['day', 'week', 'sku', 'cex', 'sapb']
+
+
+def filter_offline(tdt):
+    """
+    Offline sales from transactions data: tdt['the_to_type'] == 'offline'
+    """
+    return F.lower(tdt['the_to_type']) == 'offline'
+
+
+def filter_online(dyd):
+    """
+    Online sales from delivery data, non-canceled:
+        dyd['the_to_type'] == 'online'
+        dyd['tdt_type_detail'] == 'sale'
+        dyd['the_transaction_status'] != 'canceled'
+    """
+    return (F.lower(dyd['the_to_type']) == 'online') & \
+        (F.lower(dyd['tdt_type_detail']) == 'sale') & \
+        (dyd['the_transaction_status'] != 'canceled')
+
+
+def get_offline_stores(but, sapb):
+    """
+    Physical stores (but['but_num_typ_but'] == 7) and the purchase organization of their plant
+    """
+    stores = but.filter(but['but_num_typ_but'] == 7)
+    return stores \
+        .join(sapb,
+              on=stores['but_num_business_unit'].cast('string') == F.regexp_replace(sapb['plant_id'], '^0*|\s', ''),
+              how='inner') \
+        .select(stores['but_idr_business_unit'], sapb['purch_org'])
+
+
+def get_online_stores(but, gdc, sapb):
+    """
+    Stock origins of the deliveries and the purchase organization of their plant, found by the EAN
+    """
+    return but \
+        .join(gdc,
+              on=but['but_code_international'] == F.concat(gdc['ean_1'], gdc['ean_2'], gdc['ean_3']),
+              how='inner') \
+        .join(sapb,
+              on=sapb['plant_id'] == gdc['plant_id'],
+              how='inner') \
+        .select(but['but_idr_business_unit'], sapb['purch_org'])
+
+
+# Channel -> its raw table, the filter of its sales lines, the mapping of its columns to the narrow schema
+# (only the renamed ones) and its store -> purchase organization mapping, with the dimensions it reads.
+# A new channel (e.g. marketplace) only adds a declaration: the joins & the aggregation are shared.
+FACT_SOURCES = OrderedDict([
+    ('offline', {'table': 'tdt',
+                 'filter': filter_offline,
+                 'columns': {},
+                 'stores': get_offline_stores,
+                 'dimensions': ['but', 'sapb']}),
+    ('online', {'table': 'dyd',
+                'filter': filter_online,
+                'columns': {'but_idr_business_unit': 'but_idr_business_unit_stock_origin',
+                            'f_pri_regular_sales_unit': 'f_tdt_pri_regular_sales_unit'},
+                'stores': get_online_stores,
+                'dimensions': ['but', 'gdc', 'sapb']}),
+])
+
+
+def get_fact_tables():
+    """
+    Get the raw tables of the channels
+
+    Returns:
+        object: (list) clean table names
+    """
+    return [source['table'] for source in FACT_SOURCES.values()]
+
+
+def get_input_tables():
+    """
+    Get all the clean tables read to build the sales lines
+
+    Returns:
+        object: (list) clean table names
+    """
+    dimensions = [d for source in FACT_SOURCES.values() for d in source['dimensions']]
+    return get_fact_tables() + sorted(set(dimensions + SHARED_DIMENSIONS))
+
+
+def get_fact_lines(tables):
+    """
+    Filter the raw table of each channel, map it to the narrow schema and union the channels
+
+    Args:
+        tables: (dict) table name -> filtered clean table
+
+    Returns:
+        (SparkDataframe): FACT_COLUMNS & channel
+    """
+    fact_lines = []
+    for channel, source in FACT_SOURCES.items():
+        raw = tables[source['table']]
+        fact_lines.append(raw
+                          .filter(source['filter'](raw))
+                          .select(*[raw[source['columns'].get(c, c)].alias(c) for c in FACT_COLUMNS],
+                                  F.lit(channel).alias('channel')))
+    return reduce(lambda left, right: left.union(right), fact_lines)
+
+
+def get_store_mapping(tables):
+    """
+    Union the store -> purchase organization mappings of the channels
+
+    Args:
+        tables: (dict) table name -> filtered clean table
+
+    Returns:
+        (SparkDataframe): but_idr_business_unit, purch_org, channel
+    """
+    stores = [source['stores'](*[tables[d] for d in source['dimensions']]).withColumn('channel', F.lit(channel))
+              for channel, source in FACT_SOURCES.items()]
+    return reduce(lambda left, right: left.union(right), stores)
+
+
+def get_sales_lines(fact_lines, tables, taiwan):
+    """
+    Join the sales lines of all the channels with the dimensions once:
+    1.Keep the sales lines of the filtered days, of a known sku and of a store of the channel with a plant
+    2.Delete the product that taiwan by from other way:
+        ~((sku['mdl_num_model_r3'].isin(taiwan)) & (stores['purch_org'] == 'Z024'))
+
+    Args:
+        fact_lines: (SparkDataframe) output of get_fact_lines
+        tables: (dict) table name -> filtered clean table
+        taiwan: (list) models sold in Taiwan by another way
+
+    Returns:
+        (SparkDataframe): sales lines at the grain of the sales cube, with their measures
+    """
+    day, week, sku, cex = tables['day'], tables['week'], tables['sku'], tables['cex']
+    # One row per store & plant purchase organization: always small, but the hints of but, gdc & sapb do not
+    # go through the joins & the union of the mappings and their estimated size is the product of their inputs
+    stores = F.broadcast(get_store_mapping(tables))
+    # The broadcasted stores are joined before sku: the lines of the stores of other purchase organizations
+    # (e.g. of the other shards) are dropped before the shuffle of the sku join
+    sales_lines = fact_lines \
+        .join(day,
+              on=F.to_date(fact_lines['tdt_date_to_ordered'], 'yyyy-MM-dd') == day['day_id_day'],
+              how='inner') \
+        .join(week,
+              on=week['wee_id_week'] == day['wee_id_week'],
+              how='inner') \
+        .join(stores,
+              on=(stores['but_idr_business_unit'] == fact_lines['but_idr_business_unit']) &
+                 (stores['channel'] == fact_lines['channel']),
+              how='inner') \
+        .join(sku,
+              on=sku['sku_idr_sku'] == fact_lines['sku_idr_sku'],
+              how='inner') \
+        .join(cex,
+              on=cex['cur_idr_currency'] == fact_lines['cur_idr_currency'],
+              how='left') \
+        .filter(~((sku['mdl_num_model_r3'].isin(taiwan)) & (stores['purch_org'] == 'Z024'))) \
+        .select(sku['mdl_num_model_r3'].alias('model_id'),
+                day['wee_id_week'].cast('int').alias('week_id'),
+                week['day_first_day_week'].alias('date'),
+                day['day_id_day'].alias('day_id'),
+                fact_lines['but_idr_business_unit'],
+                fact_lines['f_qty_item'],
+                fact_lines['f_pri_regular_sales_unit'],
+                fact_lines['f_to_tax_in'],
+                cex['exchange_rate'],
+                fact_lines['channel'])
+    return sales_lines
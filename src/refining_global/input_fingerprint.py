@@ -0,0 +1,159 @@
+import hashlib
+import json
+
+import src.tools.utils as ut
+
+import stages
+
+import pyspark.sql.functions as F
+
+
+MANIFEST_PATH = '_manifests/inputs.json'
+
+
+def get_table_fingerprint(spark, bucket, path, df):
+    """
+    Fingerprint a clean table from its file listing (name, size & modification time of each file)
+    and its max technical date.
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) S3 bucket
+        path: (string) full path to the parquet directory within the S3 bucket
+        df: (SparkDataframe) the table, as read from the clean bucket
+
+    Returns:
+        object: (dict) fingerprint of the table
+    """
+    fs, hadoop_path = ut.get_hadoop_path(spark, bucket, path)
+    files = []
+    it = fs.listFiles(hadoop_path, True)
+    while it.hasNext():
+        status = it.next()
+        files.append('{}|{}|{}'.format(status.getPath().toString(), status.getLen(), status.getModificationTime()))
+    files.sort()
+
+    max_technical_date = None
+    if 'rs_technical_date' in df.columns:
+        max_technical_date = df.agg(F.max('rs_technical_date')).collect()[0][0]
+
+    return {
+        'num_files': len(files),
+        'size_bytes': sum([int(f.split('|')[1]) for f in files]),
+        'listing_hash': hashlib.sha1('\n'.join(files).encode('utf-8')).hexdigest(),
+        'max_technical_date': str(max_technical_date),
+    }
+
+
+def get_table_fingerprints(spark, bucket, path_clean_datalake, clean_tables, tables):
+    """
+    Fingerprint all clean tables read by the refining
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) clean S3 bucket
+        path_clean_datalake: (string) prefix of the clean tables
+        clean_tables: (dict) table name -> path of the table under the prefix
+        tables: (dict) table name -> the table, as read from the clean bucket
+
+    Returns:
+        object: (dict) table name -> fingerprint of the table
+    """
+    table_fingerprints = {}
+    for name, df in tables.items():
+        table_fingerprints[name] = get_table_fingerprint(spark, bucket, path_clean_datalake + clean_tables[name], df)
+        print('[{}] {}'.format(name, table_fingerprints[name]))
+    return table_fingerprints
+
+
+def get_output_fingerprints(table_fingerprints, output_params, outputs, last_manifest):
+    """
+    Combine the fingerprints of the input tables (declared by the stages), the functional parameters
+    and the upstream outputs into one fingerprint per output. The outputs reduced to the models found in
+    model_week_sales are stale as soon as model_week_sales is.
+
+    Args:
+        table_fingerprints: (dict) table name -> fingerprint of the table
+        output_params: (dict) output name -> functional parameters used to compute the output
+        outputs: (list) outputs (stages) to fingerprint, in execution order
+        last_manifest: (dict) manifest of the last successful run, giving the fingerprint of the published
+            upstream outputs which are not fingerprinted
+
+    Returns:
+        object: (dict) output name -> fingerprint (sha1)
+    """
+    output_fingerprints = {}
+    last_fingerprints = last_manifest.get('outputs', {})
+    for output in outputs:
+        content = {
+            'tables': {name: table_fingerprints[name] for name in stages.STAGES[output]['inputs']},
+            'params': output_params[output],
+            'upstream': {name: output_fingerprints.get(name, last_fingerprints.get(name))
+                         for name in stages.STAGES[output]['upstream']},
+        }
+        serialized = json.dumps(content, sort_keys=True, default=str)
+        output_fingerprints[output] = hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+    return output_fingerprints
+
+
+def read_manifest(spark, bucket, path_refined_global):
+    """
+    Read the input manifest of the last successful run
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) refined S3 bucket
+        path_refined_global: (string) prefix of the refined tables
+
+    Returns:
+        object: (dict) the manifest, empty if there is no previous run
+    """
+    manifest = ut.spark_read_text_s3(spark, bucket, path_refined_global + MANIFEST_PATH)
+    return json.loads(manifest) if manifest else {}
+
+
+def get_stale_outputs(output_fingerprints, last_manifest, force=False):
+    """
+    Get the outputs whose fingerprint changed since the last successful run
+
+    Args:
+        output_fingerprints: (dict) output name -> fingerprint of the current run
+        last_manifest: (dict) manifest of the last successful run
+        force: (bool) consider all outputs as stale
+
+    Returns:
+        object: (list) names of the outputs to recompute
+    """
+    last_fingerprints = last_manifest.get('outputs', {})
+    return [output for output, fingerprint in output_fingerprints.items()
+            if force or last_fingerprints.get(output) != fingerprint]
+
+
+def write_manifest(spark, bucket, path_refined_global, run_id, table_fingerprints, output_fingerprints,
+                   last_manifest, written_outputs):
+    """
+    Record the fingerprints of the outputs written by this run.
+    Outputs which were not recomputed keep the fingerprint of the run which wrote them,
+    tables which were not read keep their last fingerprint.
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) refined S3 bucket
+        path_refined_global: (string) prefix of the refined tables
+        run_id: (string) id of the current run
+        table_fingerprints: (dict) table name -> fingerprint of the table
+        output_fingerprints: (dict) output name -> fingerprint of the current run
+        last_manifest: (dict) manifest of the last successful run
+        written_outputs: (list) names of the outputs written by this run
+    """
+    manifest = {
+        'outputs': dict(last_manifest.get('outputs', {})),
+        'runs': dict(last_manifest.get('runs', {})),
+        'tables': dict(last_manifest.get('tables', {})),
+    }
+    manifest['tables'].update(table_fingerprints)
+    for output in written_outputs:
+        manifest['outputs'][output] = output_fingerprints[output]
+        manifest['runs'][output] = run_id
+    ut.spark_write_text_s3(spark, bucket, path_refined_global + MANIFEST_PATH,
+                           json.dumps(manifest, indent=2, sort_keys=True))
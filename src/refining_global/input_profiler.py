@@ -0,0 +1,174 @@
+import math
+import time
+
+import src.tools.utils as ut
+
+import pyspark.sql.functions as F
+
+
+# Broadcast decision of each joined dimension when the profiler is disabled
+DEFAULT_BROADCAST = {
+    'day': True,
+    'week': True,
+    'sku': False,
+    'but': True,
+    'gdc': True,
+    'cex': True,
+    'sapb': True,
+}
+
+
+def get_table_stats(spark, bucket, path):
+    """
+    Get cheap statistics of a parquet table:
+        - number of files & size from the file listing
+        - number of rows from the parquet footers (a count without any column does not read the data pages)
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) S3 bucket
+        path: (string) full path to the parquet directory within the S3 bucket
+
+    Returns:
+        object: (dict) statistics of the table
+    """
+    num_files, size_bytes = ut.get_size_s3(spark, bucket, path)
+    num_rows = ut.spark_read_parquet_s3(spark, bucket, path).count()
+    return {'num_files': num_files, 'size_bytes': size_bytes, 'num_rows': num_rows}
+
+
+def get_input_stats(spark, bucket, path_clean_datalake, clean_tables, table_names):
+    """
+    Get the statistics of all profiled clean tables
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) clean S3 bucket
+        path_clean_datalake: (string) prefix of the clean tables
+        clean_tables: (dict) table name -> path of the table under the prefix
+        table_names: (list) names of the tables to profile
+
+    Returns:
+        object: (dict) table name -> statistics
+    """
+    input_stats = {}
+    for name in table_names:
+        start = time.time()
+        input_stats[name] = get_table_stats(spark, bucket, path_clean_datalake + clean_tables[name])
+        input_stats[name]['profiling_seconds'] = round(time.time() - start, 1)
+        print('[{}] {}'.format(name, input_stats[name]))
+    return input_stats
+
+
+def estimate_dimension_sizes(input_stats, dimensions, size_expansion_factor):
+    """
+    Estimate the in-memory size of each dimension after the global filters,
+    pro rata of the rows kept and inflated from the compressed parquet size.
+
+    Args:
+        input_stats: (dict) table name -> statistics of the raw table
+        dimensions: (dict) dimension name -> filtered spark dataframe
+        size_expansion_factor: (float) in-memory size / parquet size ratio
+
+    Returns:
+        object: (dict) dimension name -> estimated rows & bytes
+    """
+    dimension_stats = {}
+    for name, df in dimensions.items():
+        raw = input_stats[name]
+        num_rows = df.count()
+        selectivity = float(num_rows) / raw['num_rows'] if raw['num_rows'] else 1.0
+        dimension_stats[name] = {
+            'num_rows': num_rows,
+            'estimated_bytes': int(raw['size_bytes'] * selectivity * size_expansion_factor),
+        }
+    return dimension_stats
+
+
+def get_shuffle_partitions(input_stats, profiler_params, fact_tables):
+    """
+    Size the shuffle partitions on the facts volume
+
+    Args:
+        input_stats: (dict) table name -> statistics of the raw table
+        profiler_params: (dict) profiler parameters
+        fact_tables: (list) fact tables read by the run
+
+    Returns:
+        object: (int) number of shuffle partitions
+    """
+    fact_bytes = sum([input_stats[name]['size_bytes'] for name in fact_tables if name in input_stats]) \
+        * profiler_params['size_expansion_factor']
+    nb_partitions = int(math.ceil(fact_bytes / (profiler_params['target_partition_mb'] * 1024 ** 2)))
+    return max(profiler_params['min_shuffle_partitions'], min(profiler_params['max_shuffle_partitions'], nb_partitions))
+
+
+def get_execution_plan(spark, bucket, path_clean_datalake, clean_tables, dimensions, profiler_params,
+                       fact_tables):
+    """
+    Collect the input statistics and decide the shuffle partitions, broadcast threshold & broadcast hints.
+    If the profiler is disabled, the static Spark configuration and the default hints are kept.
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) clean S3 bucket
+        path_clean_datalake: (string) prefix of the clean tables
+        clean_tables: (dict) table name -> path of the table under the prefix
+        dimensions: (dict) dimension name -> filtered spark dataframe
+        profiler_params: (dict) profiler parameters
+        fact_tables: (list) fact tables read by the run
+
+    Returns:
+        object: (dict) the execution plan
+    """
+    if not profiler_params['enabled']:
+        return {'enabled': False, 'broadcast': dict(DEFAULT_BROADCAST)}
+
+    input_stats = get_input_stats(spark, bucket, path_clean_datalake, clean_tables,
+                                  list(fact_tables) + list(dimensions.keys()))
+    dimension_stats = estimate_dimension_sizes(input_stats, dimensions, profiler_params['size_expansion_factor'])
+    broadcast_threshold = profiler_params['broadcast_threshold_mb'] * 1024 ** 2
+    broadcast = {name: stats['estimated_bytes'] <= broadcast_threshold for name, stats in dimension_stats.items()}
+    # Spark compares its automatic broadcast threshold to the compressed parquet sizes of the tables not profiled
+    # (e.g. gdw, sms, intermediate aggregates): scaled down, so that they stay under the same in-memory size
+    auto_broadcast_threshold = int(broadcast_threshold / profiler_params['size_expansion_factor'])
+
+    return {
+        'enabled': True,
+        'shuffle_partitions': get_shuffle_partitions(input_stats, profiler_params, fact_tables),
+        'broadcast_threshold_bytes': broadcast_threshold,
+        'auto_broadcast_threshold_bytes': auto_broadcast_threshold,
+        'broadcast': broadcast,
+        'input_stats': input_stats,
+        'dimension_stats': dimension_stats,
+    }
+
+
+def apply_execution_plan(spark, plan):
+    """
+    Set the runtime Spark configuration decided by the profiler
+
+    Args:
+        spark: (SparkSession) spark app
+        plan: (dict) the execution plan
+    """
+    if plan['enabled']:
+        spark.conf.set('spark.sql.shuffle.partitions', str(plan['shuffle_partitions']))
+        spark.conf.set('spark.sql.autoBroadcastJoinThreshold', str(plan['auto_broadcast_threshold_bytes']))
+    plan['shuffle_partitions'] = int(spark.conf.get('spark.sql.shuffle.partitions'))
+
+
+def hint(df, name, plan):
+    """
+    Add the broadcast hint of a dimension according to the execution plan.
+    The hint follows the dataframe through the filters applied in the refining functions.
+
+    Args:
+        df: (SparkDataframe) the dimension
+        name: (string) name of the dimension
+        plan: (dict) the execution plan
+
+    Returns:
+        (SparkDataframe): the dimension, with a broadcast hint if decided
+    """
+    return F.broadcast(df) if plan['broadcast'].get(name, False) else df
@@ -1,19 +1,55 @@
 # -*- coding: utf-8 -*-
+import sys
 import time
 
 import src.tools.utils as ut
 import src.tools.get_config as conf
 import src.tools.parse_config as parse_config
+import src.tools.storage as storage
+import src.tools.spark_metrics as metrics
+from src.tools.run_report import RunReport
 
 import generic_filter as gf
+import fact_sources as fs
 import model_week_sales as sales
 import model_week_tree as tree
 import model_week_mrp as mrp
 import check_functions as check
+import input_profiler as profiler
+import input_fingerprint as fp
+import partitioning as part
+import output_checksum as checksum
+import sharding
+import backtesting as bt
+import matrix_export
+import anomaly_detection as anomaly
+import time_slicing
+import stages
 
 from pyspark import SparkConf, StorageLevel
 from pyspark.sql import SparkSession
 
+# Clean tables read by the refining, with their path under the clean datalake prefix
+CLEAN_TABLES = {
+    'tdt': 'f_transaction_detail/',
+    'dyd': 'f_delivery_detail/',
+    'cex': 'f_currency_exchange/',
+    'sku': 'd_sku/',
+    'sku_h': 'd_sku_h/',
+    'but': 'd_business_unit/',
+    'sapb': 'sites_attribut_0plant_branches_h/',
+    'gdw': 'd_general_data_warehouse_h/',
+    'gdc': 'd_general_data_customer/',
+    'day': 'd_day/',
+    'week': 'd_week/',
+    'sms': 'apo_sku_mrp_status_h/',
+    'zep': 'ecc_zaa_extplan/',
+}
+
+# Row groups of the refined tables, sorted on the model & the week so that the readers filtering on them
+# (e.g. src/tools/refined_reader.py) skip most of the row groups
+REFINED_ROW_GROUP_MB = 16
+
 if __name__ == '__main__':
     # Get params
     print('Getting parameters...')
@@ -26,105 +62,295 @@ if __name__ == '__main__':
     current_week = ut.get_current_week_id()
     print('Current week: {}'.format(current_week))
     print('==> Global refined data will be uploaded up to this week (excluded).')
+    report = RunReport(current_week)
+    backtest_cutoffs = vars(args)['backtest_cutoffs']
+    if backtest_cutoffs:
+        backtest_cutoffs = bt.parse_cutoffs(backtest_cutoffs, params.first_historical_week, current_week)
+        print('==> Backtesting mode, cutoffs: {}'.format(backtest_cutoffs))
+        report.add('backtesting', 'cutoffs', backtest_cutoffs)
 
     # Set up Spark Session
     print('Setting up Spark Session...')
-    spark_conf = SparkConf().setAll(params.list_conf)
+    storage.configure(params.storage)
+    spark_conf = SparkConf().setAll(
+        params.list_conf + storage.get_storage().get_spark_conf() + sharding.get_spark_conf(params.sharding))
     spark = SparkSession.builder.config(conf=spark_conf).enableHiveSupport().getOrCreate()
     spark.sparkContext.setLogLevel('ERROR')
 
-    # Load all needed clean data
+    # Select the stages to run, and load only the clean tables they read
+    selected_stages = stages.select_stages(vars(args)['only'], vars(args)['from_stages'])
+    if backtest_cutoffs and selected_stages != stages.get_ordered_stages():
+        raise Exception('The backtesting mode runs all the stages, --only & --from cannot be used')
+    print('Stages selected: {}, reusing the published outputs of {}'.format(
+        selected_stages, stages.get_reused_stages(selected_stages)))
+    report.add('stages', 'selected', selected_stages)
+
     print('Load data from clean bucket.')
     bucket_clean = params.bucket_clean
     path_clean_datalake = params.path_clean_datalake
-    tdt = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'f_transaction_detail/')
-    dyd = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'f_delivery_detail/')
-    cex = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'f_currency_exchange/')
-    sku = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'd_sku/')
-    sku_h = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'd_sku_h/')
-    but = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'd_business_unit/')
-    sapb = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'sites_attribut_0plant_branches_h/')
-    gdw = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'd_general_data_warehouse_h/')
-    gdc = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'd_general_data_customer/')
-    day = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'd_day/')
-    week = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'd_week/')
-    sms = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'apo_sku_mrp_status_h/')
-    zep = ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + 'ecc_zaa_extplan/')
+    tables = {name: ut.spark_read_parquet_s3(spark, bucket_clean, path_clean_datalake + CLEAN_TABLES[name])
+              for name in stages.get_input_tables(selected_stages)}
+
+    # Detect the outputs whose inputs changed since the last successful run
+    bucket_refined = params.bucket_refined
+    path_refined_global = params.path_refined_global
+    if params.fingerprint['enabled'] and not backtest_cutoffs:
+        print('Fingerprint inputs.')
+        table_fingerprints = fp.get_table_fingerprints(spark, bucket_clean, path_clean_datalake, CLEAN_TABLES, tables)
+        last_manifest = fp.read_manifest(spark, bucket_refined, path_refined_global)
+        output_fingerprints = fp.get_output_fingerprints(table_fingerprints, {
+            'model_week_sales': {'current_week': current_week,
+                                 'first_historical_week': params.first_historical_week,
+                                 'list_purch_org': params.list_purch_org,
+                                 'taiwan_list': params.taiwan_list,
+                                 'but_week': params.but_week,
+                                 'store_count': params.store_count,
+                                 'matrix_export': params.matrix_export},
+            'model_week_tree': {'current_week': current_week,
+                                'first_historical_week': params.first_historical_week,
+                                'first_backtesting_cutoff': params.first_backtesting_cutoff,
+                                'write_model_week_tree': params.write_model_week_tree},
+            'model_week_mrp': {'current_week': current_week,
+                               'first_historical_week': params.first_historical_week,
+                               'first_backtesting_cutoff': params.first_backtesting_cutoff,
+                               'list_purch_org': params.list_purch_org,
+                               'white_list': params.white_list}}, selected_stages, last_manifest)
+        stale_outputs = fp.get_stale_outputs(output_fingerprints, last_manifest, force=vars(args)['force'])
+    else:
+        stale_outputs = selected_stages
+    report.add('fingerprint', 'stale_outputs', stale_outputs)
+    print('Outputs to refine: {}'.format(stale_outputs))
+    if not stale_outputs:
+        print('==> Inputs unchanged since the last successful run, nothing to refine.')
+        report.write(spark, bucket_refined, path_refined_global + 'run_report/')
+        spark.stop()
+        sys.exit(0)
 
     # Apply global filters
     print('Make global filter.')
-    cex = gf.filter_current_exchange(cex)
-    sku = gf.filter_sku(sku)
-    sku_h = gf.filter_sku(sku_h)
-    day = gf.filter_day(day, params.first_historical_week, current_week)
-    week = gf.filter_week(week, params.first_historical_week, current_week)
-    sapb = gf.filter_sapb(sapb, params.list_purch_org)
-    gdw = gf.filter_gdw(gdw)
-    dyd = gf.filter_dyd(dyd)
-    channel = gf.filter_channel(but)
-
-    # Create model_week_sales
-    model_week_sales = sales.get_model_week_sales(
-        tdt, dyd, day, week, sku, but, cex, sapb, gdc, current_week,
-        params.taiwan_list, channel, params.bucket_refined, params.but_path, params.but_week)
-    model_week_sales.persist(StorageLevel.MEMORY_ONLY)
-    print('====> counting(cache) [model_week_sales] took ')
-    start = time.time()
-    model_week_sales_count = model_week_sales.count()
-    ut.get_timer(starting_time=start)
-    print('[model_week_sales] length:', model_week_sales_count)
-
-    # Create model_week_tree
-    model_week_tree = tree.get_model_week_tree(sku_h, week, params.first_backtesting_cutoff)
-    model_week_tree.persist(StorageLevel.MEMORY_ONLY)
-    print('====> counting(cache) [model_week_tree] took ')
-    start = time.time()
-    model_week_tree_count = model_week_tree.count()
-    ut.get_timer(starting_time=start)
-    print('[model_week_tree] length:', model_week_tree_count)
+    global_filters = {
+        'cex': gf.filter_current_exchange,
+        'sku': gf.filter_sku,
+        'sku_h': gf.filter_sku,
+        'day': lambda df: gf.filter_day(df, params.first_historical_week, current_week),
+        'week': lambda df: gf.filter_week(df, params.first_historical_week, current_week),
+        'sapb': lambda df: gf.filter_sapb(df, params.list_purch_org),
+        'gdw': gf.filter_gdw,
+        'dyd': gf.filter_dyd,
+    }
+    for name, global_filter in global_filters.items():
+        if name in tables:
+            tables[name] = global_filter(tables[name])
+    if 'but' in tables:
+        tables['channel'] = gf.filter_channel(tables['but'])
+
+    # Profile inputs to tune the shuffles & the broadcast joins of this run
+    print('Profile inputs.')
+    dimensions = {name: tables[name] for name in profiler.DEFAULT_BROADCAST if name in tables}
+    plan = profiler.get_execution_plan(
+        spark, bucket_clean, path_clean_datalake, CLEAN_TABLES, dimensions, params.profiler,
+        fact_tables=[name for name in fs.get_fact_tables() if name in tables])
+    profiler.apply_execution_plan(spark, plan)
+    for key, value in plan.items():
+        report.add('execution_plan', key, value)
+    print('[execution plan] shuffle partitions: {}, broadcast: {}'.format(plan['shuffle_partitions'],
+                                                                          plan['broadcast']))
+
+    # Hash partition sku once on its join key with the sales facts
+    path_intermediate = path_refined_global + '_intermediate/'
+    if 'sku' in tables and not plan['broadcast']['sku']:
+        tables['sku'] = part.co_partition(spark, tables['sku'], 'sku', 'sku_idr_sku', params.partitioning,
+                                          plan['shuffle_partitions'], bucket_refined, path_intermediate)
+
+    for name in dimensions:
+        tables[name] = profiler.hint(tables[name], name, plan)
+
+    # Sharded mode: sales & MRP from APO computed per shard of purchase organizations, then merged
+    use_shards = params.sharding['enabled'] and \
+        'model_week_sales' in stale_outputs and 'model_week_mrp' in stale_outputs
+    if use_shards:
+        print('====> Computing shards...')
+        path_shards = path_refined_global + '_shards/'
+        shards = sharding.get_shards(params.list_purch_org, params.sharding)
+        shard_reports = sharding.run_shards(
+            spark, sharding.select_shards(shards, vars(args)['shards']), tables, params, current_week,
+            bucket_refined, path_shards, report.run_id)
+        report.add('sharding', 'shards', shard_reports)
+        print('====> Merging shards...')
+        shard_sales_cube, shard_model_week_mrp_apo = sharding.merge_shards(
+            spark, shards, current_week, bucket_refined, path_shards)
+
+    # Create model_week_sales, or reuse the published one if its inputs did not change
+    if 'model_week_sales' in stale_outputs:
+        if use_shards:
+            model_week_sales = sales.get_model_week_sales_from_cube(
+                shard_sales_cube, current_week, params.bucket_refined, params.but_path, params.but_week,
+                write_bi=not backtest_cutoffs, store_count_params=params.store_count)
+        elif params.time_slicing['enabled']:
+            print('====> Computing the sales cube by slices of {} weeks...'
+                  .format(params.time_slicing['weeks_per_slice']))
+            path_slices = path_intermediate + 'sales_cube/'
+            slice_reports = time_slicing.run_slices(
+                spark, tables, params, current_week, plan['shuffle_partitions'], bucket_refined, path_slices)
+            report.add('time_slicing', 'slices', slice_reports)
+            model_week_sales = sales.get_model_week_sales_from_cube(
+                ut.spark_read_parquet_s3(spark, bucket_refined, path_slices), current_week, params.bucket_refined,
+                params.but_path, params.but_week, write_bi=not backtest_cutoffs, store_count_params=params.store_count)
+        else:
+            model_week_sales = sales.get_model_week_sales(
+                tables, current_week, params.taiwan_list, params.bucket_refined, params.but_path, params.but_week,
+                write_bi=not backtest_cutoffs, store_count_params=params.store_count)
+        model_week_sales.persist(StorageLevel.MEMORY_ONLY)
+        print('====> counting(cache) [model_week_sales] took ')
+        start = time.time()
+        model_week_sales_count = model_week_sales.count()
+        ut.get_timer(starting_time=start)
+        print('[model_week_sales] length:', model_week_sales_count)
+    elif 'model_week_tree' in stale_outputs or 'model_week_mrp' in stale_outputs:
+        print('====> Reusing published [model_week_sales]')
+        model_week_sales = ut.spark_read_parquet_s3(spark, bucket_refined, path_refined_global + 'model_week_sales')
+    if 'model_week_tree' in stale_outputs or 'model_week_mrp' in stale_outputs:
+        # Hash partitioned on model_id in spark.sql.shuffle.partitions, like the model keyed intermediates
+        l_model_id = model_week_sales.select('model_id').drop_duplicates().persist(StorageLevel.MEMORY_ONLY)
+
+    # Create model_tree_history, and its expansion week by week model_week_tree
+    if 'model_week_tree' in stale_outputs:
+        model_tree_history = tree.get_model_tree_history(tables['sku_h'], tables['week'],
+                                                         params.first_backtesting_cutoff)
+        model_tree_history = part.co_partition(spark, model_tree_history, 'model_tree_history', 'model_id',
+                                               params.partitioning, plan['shuffle_partitions'],
+                                               bucket_refined, path_intermediate)
+        print('====> counting(cache) [model_tree_history] took ')
+        start = time.time()
+        model_tree_history_count = model_tree_history.count()
+        ut.get_timer(starting_time=start)
+        print('[model_tree_history] length:', model_tree_history_count)
 
     # Create model_week_mrp
-    model_week_mrp = mrp.get_model_week_mrp(
-        gdw, sapb, sku, day, sms, zep, week, params.white_list, params.first_backtesting_cutoff)
-    model_week_mrp.persist(StorageLevel.MEMORY_ONLY)
-    print('====> counting(cache) [model_week_mrp] took ')
-    start = time.time()
-    model_week_mrp_count = model_week_mrp.count()
-    ut.get_timer(starting_time=start)
-    print('[model_week_mrp] length:', model_week_mrp_count)
-
-    # Reduce tables according to the models found in model_week_sales
-    print('====> Reducing tables according to the models found in model_week_sales...')
-    l_model_id = model_week_sales.select('model_id').drop_duplicates()
-    model_week_tree = model_week_tree.join(l_model_id, on='model_id', how='inner')
-    model_week_mrp = model_week_mrp.join(l_model_id, on='model_id', how='inner')
-
-    print('[model_week_tree] (new) length:', model_week_tree.count())
-    print('[model_week_mrp] (new) length:', model_week_mrp.count())
-
-    # Split model_week_sales into 3 tables
-    print('====> Splitting sales, price & turnover into 3 tables...')
-    model_week_price = model_week_sales.select(['model_id', 'week_id', 'date', 'channel', 'average_price'])
-    model_week_turnover = model_week_sales.select(['model_id', 'week_id', 'date', 'channel', 'sum_turnover'])
-    model_week_sales = model_week_sales.select(['model_id', 'week_id', 'date', 'channel', 'sales_quantity'])
-
-    # Data checks & assertions
-    check.check_d_sku(sku)
-    check.check_d_business_unit(but)
-    check.check_sales_stability(model_week_sales, current_week)
-    check.check_duplicate_by_keys(model_week_sales, ['model_id', 'week_id', 'date', 'channel'])
-    check.check_duplicate_by_keys(model_week_price, ['model_id', 'week_id', 'date', 'channel'])
-    check.check_duplicate_by_keys(model_week_turnover, ['model_id', 'week_id', 'date', 'channel'])
-    check.check_duplicate_by_keys(model_week_tree, ['model_id', 'week_id'])
-    check.check_duplicate_by_keys(model_week_mrp, ['model_id', 'week_id'])
+    if 'model_week_mrp' in stale_outputs:
+        if use_shards:
+            model_week_mrp = mrp.merge_model_week_mrp(
+                shard_model_week_mrp_apo, tables['sms'], tables['zep'], tables['week'], tables['sku'],
+                params.first_backtesting_cutoff)
+        else:
+            model_week_mrp = mrp.get_model_week_mrp(
+                tables['gdw'], tables['sapb'], tables['sku'], tables['day'], tables['sms'], tables['zep'],
+                tables['week'], params.white_list, params.first_backtesting_cutoff)
+        model_week_mrp = part.co_partition(spark, model_week_mrp, 'model_week_mrp', 'model_id', params.partitioning,
+                                           plan['shuffle_partitions'], bucket_refined, path_intermediate)
+        print('====> counting(cache) [model_week_mrp] took ')
+        start = time.time()
+        model_week_mrp_count = model_week_mrp.count()
+        ut.get_timer(starting_time=start)
+        print('[model_week_mrp] length:', model_week_mrp_count)
+
+    # Backtesting mode: derive the tables of all cutoffs from the tables computed once, then stop
+    if backtest_cutoffs:
+        print('====> Deriving the backtesting tables of {} cutoffs...'.format(len(backtest_cutoffs)))
+        backtest_tables = bt.get_backtest_tables(spark, backtest_cutoffs, model_week_sales, model_tree_history,
+                                                 model_week_mrp, tables['week'], params.first_backtesting_cutoff,
+                                                 params.write_model_week_tree)
+        # Only the partitions of the given cutoffs are overwritten
+        for name, df in backtest_tables.items():
+            bt.write_backtest_table(spark, df, backtest_cutoffs, bucket_refined,
+                                    path_refined_global + 'backtesting/' + name, plan['shuffle_partitions'],
+                                    ['model_id', checksum.get_partition_column(name)], REFINED_ROW_GROUP_MB)
+
+        report.add('io', 'scheme', storage.get_storage().scheme)
+        report.add('io', 'operations', storage.get_storage().io_stats)
+        report.add('io', 'spark_input', metrics.get_app_input_metrics(spark))
+        report.pretty_print()
+        report.write(spark, bucket_refined, path_refined_global + 'run_report/')
+        spark.stop()
+        sys.exit(0)
+
+    if 'model_week_tree' in stale_outputs:
+        # Reduce table according to the models found in model_week_sales
+        model_tree_history = model_tree_history.join(l_model_id, on='model_id', how='inner')
+        print('[model_tree_history] (new) length:', model_tree_history.count())
+        check.check_duplicate_by_keys(model_tree_history, ['model_id', 'valid_from_week'])
+
+        if params.write_model_week_tree:
+            model_week_tree = tree.expand_model_tree_history(model_tree_history, tables['week'],
+                                                             params.first_backtesting_cutoff)
+            print('[model_week_tree] length:', model_week_tree.count())
+            check.check_duplicate_by_keys(model_week_tree, ['model_id', 'week_id'])
+
+    if 'model_week_mrp' in stale_outputs:
+        # Reduce table according to the models found in model_week_sales
+        model_week_mrp = model_week_mrp.join(l_model_id, on='model_id', how='inner')
+        print('[model_week_mrp] (new) length:', model_week_mrp.count())
+        check.check_duplicate_by_keys(model_week_mrp, ['model_id', 'week_id'])
+
+    if 'model_week_sales' in stale_outputs:
+        # Split model_week_sales into 3 tables
+        print('====> Splitting sales, price & turnover into 3 tables...')
+        model_week_measures = model_week_sales
+        model_week_price = model_week_sales.select(['model_id', 'week_id', 'date', 'channel', 'average_price'])
+        model_week_turnover = model_week_sales.select(['model_id', 'week_id', 'date', 'channel', 'sum_turnover'])
+        model_week_sales = model_week_sales.select(['model_id', 'week_id', 'date', 'channel', 'sales_quantity'])
+
+        # Data checks & assertions
+        check.check_d_sku(tables['sku'])
+        check.check_d_business_unit(tables['but'])
+        if params.anomaly_detection['enabled']:
+            print('====> Detecting sales anomalies by model & channel...')
+            report.add('anomalies', 'summary', anomaly.detect_sales_anomalies(
+                model_week_sales, current_week, bucket_refined, path_refined_global, params.anomaly_detection))
+        check.check_sales_stability(model_week_sales, current_week)
+        check.check_duplicate_by_keys(model_week_sales, ['model_id', 'week_id', 'date', 'channel'])
+        check.check_duplicate_by_keys(model_week_price, ['model_id', 'week_id', 'date', 'channel'])
+        check.check_duplicate_by_keys(model_week_turnover, ['model_id', 'week_id', 'date', 'channel'])
 
     # Write results
-    bucket_refined = params.bucket_refined
-    path_refined_global = params.path_refined_global
-    ut.spark_write_parquet_s3(model_week_sales, bucket_refined, path_refined_global + 'model_week_sales')
-    ut.spark_write_parquet_s3(model_week_price, bucket_refined, path_refined_global + 'model_week_price')
-    ut.spark_write_parquet_s3(model_week_turnover, bucket_refined, path_refined_global + 'model_week_turnover')
-    ut.spark_write_parquet_s3(model_week_tree, bucket_refined, path_refined_global + 'model_week_tree')
-    ut.spark_write_parquet_s3(model_week_mrp, bucket_refined, path_refined_global + 'model_week_mrp')
+    written_tables = {}
+    if 'model_week_sales' in stale_outputs:
+        written_tables['model_week_sales'] = model_week_sales
+        written_tables['model_week_price'] = model_week_price
+        written_tables['model_week_turnover'] = model_week_turnover
+    if 'model_week_tree' in stale_outputs:
+        written_tables['model_tree_history'] = model_tree_history
+        if params.write_model_week_tree:
+            written_tables['model_week_tree'] = model_week_tree
+    if 'model_week_mrp' in stale_outputs:
+        written_tables['model_week_mrp'] = model_week_mrp
+    for name in list(written_tables):
+        # Persisted by the write, so that the checksums aggregate the written rows instead of recomputing the joins
+        if params.checksum['enabled']:
+            written_tables[name] = written_tables[name].persist(StorageLevel.MEMORY_AND_DISK)
+        df = written_tables[name]
+        ut.spark_write_parquet_s3(df, bucket_refined, path_refined_global + name,
+                                  sort_by=['model_id', checksum.get_partition_column(name)],
+                                  row_group_mb=REFINED_ROW_GROUP_MB, range_by=['model_id'])
+
+    # Checksums of the written partitions, to diff the outputs between runs
+    if params.checksum['enabled']:
+        print('====> Computing checksums of the written tables...')
+        checksum.write_checksum_manifest(spark, bucket_refined, path_refined_global, report.run_id,
+                                         written_tables, params.checksum['float_precision'])
+        for df in written_tables.values():
+            df.unpersist()
+
+    # Dense model x week matrices of the forecasting training, from the sales before the split,
+    # exported once the sales passed their checks & were written
+    if 'model_week_sales' in stale_outputs and params.matrix_export['enabled']:
+        print('====> Exporting model x week matrices...')
+        start = time.time()
+        matrix_metadata = matrix_export.export_model_week_matrices(
+            spark, model_week_measures, tables['week'], current_week, bucket_refined, path_refined_global,
+            report.run_id, params.matrix_export['models_per_shard'])
+        ut.get_timer(starting_time=start)
+        report.add('matrix_export', 'shape', [matrix_metadata['nb_models'], matrix_metadata['nb_weeks']])
+        report.add('matrix_export', 'shards', len(matrix_metadata['shards']))
+
+    if params.fingerprint['enabled']:
+        fp.write_manifest(spark, bucket_refined, path_refined_global, report.run_id,
+                          table_fingerprints, output_fingerprints, last_manifest, stale_outputs)
+
+    report.add('io', 'scheme', storage.get_storage().scheme)
+    report.add('io', 'operations', storage.get_storage().io_stats)
+    report.add('io', 'spark_input', metrics.get_app_input_metrics(spark))
+    report.pretty_print()
+    report.write(spark, bucket_refined, path_refined_global + 'run_report/')
 
     spark.stop()
@@ -0,0 +1,240 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+
+import src.tools.utils as ut
+
+import pyspark.sql.functions as F
+from pyspark.sql.types import IntegerType, LongType, StructField, StructType
+
+
+# Measures exported, with the value of the cells without sales
+MEASURES = {
+    'sales_quantity': 0.0,
+    'average_price': np.nan,
+    'sum_turnover': 0.0,
+}
+
+MATRIX_DIR = 'model_week_matrix/'
+
+
+def get_week_index(week, current_week):
+    """
+    Get the weeks of the matrices: all the filtered weeks before the current week, in order
+
+    Args:
+        week: (SparkDataframe) filtered weeks
+        current_week: (int) current week id
+
+    Returns:
+        object: (numpy.ndarray) int32 week ids, the position of a week is its column in the matrices
+    """
+    weeks = week \
+        .select(week['wee_id_week'].cast('int').alias('week_id')) \
+        .filter(F.col('week_id') < current_week) \
+        .distinct() \
+        .collect()
+    return np.array(sorted([w['week_id'] for w in weeks]), dtype=np.int32)
+
+
+def get_model_index(model_week_sales):
+    """
+    Get the models of the matrices, in order
+
+    Args:
+        model_week_sales: (SparkDataframe) sales, price & turnover
+
+    Returns:
+        object: (numpy.ndarray) int64 model ids, the position of a model is its row in the matrices
+    """
+    models = model_week_sales.select('model_id').distinct().collect()
+    return np.array(sorted([m['model_id'] for m in models]), dtype=np.int64)
+
+
+def get_cells(spark, model_week_sales, model_index, week_index):
+    """
+    Map the sales on the (row, column) of the matrices, with the broadcasted model & week indexes
+
+    Args:
+        spark: (SparkSession) spark app
+        model_week_sales: (SparkDataframe) sales, price & turnover
+        model_index: (numpy.ndarray) model ids
+        week_index: (numpy.ndarray) week ids
+
+    Returns:
+        (SparkDataframe): model_pos, week_pos, channel & the measures
+    """
+    models = spark.createDataFrame(
+        [(int(model_id), pos) for pos, model_id in enumerate(model_index)],
+        StructType([StructField('model_id', LongType(), False), StructField('model_pos', IntegerType(), False)]))
+    weeks = spark.createDataFrame(
+        [(int(week_id), pos) for pos, week_id in enumerate(week_index)],
+        StructType([StructField('week_id', IntegerType(), False), StructField('week_pos', IntegerType(), False)]))
+    cells = model_week_sales \
+        .withColumn('model_id', F.col('model_id').cast('long')) \
+        .withColumn('week_id', F.col('week_id').cast('int')) \
+        .join(F.broadcast(models), on=['model_id'], how='inner') \
+        .join(F.broadcast(weeks), on=['week_id'], how='inner') \
+        .select('model_pos', 'week_pos', 'channel', *MEASURES.keys())
+    return cells
+
+
+def to_matrices(cells, nb_models, nb_weeks, channels, first_model_pos):
+    """
+    Fill the dense float32 matrices of a shard from its cells
+
+    Args:
+        cells: (pandas.DataFrame) cells of the shard
+        nb_models: (int) number of models (rows) of the shard
+        nb_weeks: (int) number of weeks (columns)
+        channels: (list) channels of the export
+        first_model_pos: (int) position of the first model of the shard
+
+    Returns:
+        object: (dict) '<measure>_<channel>' -> numpy.ndarray of shape (nb_models, nb_weeks)
+    """
+    matrices = {}
+    for channel in channels:
+        channel_cells = cells[cells['channel'] == channel]
+        rows = channel_cells['model_pos'].values - first_model_pos
+        cols = channel_cells['week_pos'].values
+        for measure, fill_value in MEASURES.items():
+            matrix = np.full((nb_models, nb_weeks), fill_value, dtype=np.float32)
+            matrix[rows, cols] = channel_cells[measure].values.astype(np.float32)
+            matrices['{}_{}'.format(measure, channel)] = matrix
+    return matrices
+
+
+def to_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def write_npy(spark, bucket, path, array):
+    ut.spark_write_bytes_s3(spark, bucket, path, to_npy(array))
+
+
+def get_shard_files(cells, nb_models, nb_weeks, channels, models_per_shard):
+    """
+    Build the .npy files of each shard on the executors (one pandas group per shard), so that the driver only
+    receives the compact float32 matrices instead of the cells
+
+    Args:
+        cells: (SparkDataframe) output of get_cells
+        nb_models: (int) number of models (rows) of the matrices
+        nb_weeks: (int) number of weeks (columns)
+        channels: (list) channels of the export
+        models_per_shard: (int) number of models (rows) per shard
+
+    Returns:
+        (SparkDataframe): shard_id, name, nb_cells & data (the .npy content) of each file
+    """
+    def build_shard(shard_cells):
+        shard_id = int(shard_cells['shard_id'].iloc[0])
+        model_from = shard_id * models_per_shard
+        model_to = min(model_from + models_per_shard, nb_models)
+        matrices = to_matrices(shard_cells, model_to - model_from, nb_weeks, channels, model_from)
+        return pd.DataFrame([(shard_id, name, len(shard_cells), to_npy(matrix))
+                             for name, matrix in sorted(matrices.items())],
+                            columns=['shard_id', 'name', 'nb_cells', 'data'])
+
+    return cells \
+        .withColumn('shard_id', (F.col('model_pos') / models_per_shard).cast('int')) \
+        .groupBy('shard_id') \
+        .applyInPandas(build_shard, schema='shard_id int, name string, nb_cells long, data binary')
+
+
+def export_model_week_matrices(spark, model_week_sales, week, current_week, bucket, path_refined_global, run_id,
+                               models_per_shard):
+    """
+    Export the sales, price & turnover as dense model x week float32 matrices, one per measure & channel,
+    in .npy files that can be memory-mapped (numpy.load(file, mmap_mode='r')), under a directory of the run:
+        model_week_matrix/<run_id>/model_index.npy: model id of each row
+        model_week_matrix/<run_id>/week_index.npy: week id of each column
+        model_week_matrix/<run_id>/shard_<n>/<measure>_<channel>.npy: rows [model_from, model_to[ of the matrices
+        model_week_matrix/<run_id>/metadata.json: shapes, channels, fill values & model range of each shard
+    Only once the export is complete, model_week_matrix/latest.json (the metadata, with the directory of the run)
+    switches the readers to it: a failed run keeps the last good export. The export it replaces is kept for the
+    jobs still reading it, the older ones are removed.
+    The matrices are built on the executors and received by the driver one shard at a time.
+
+    Args:
+        spark: (SparkSession) spark app
+        model_week_sales: (SparkDataframe) sales, price & turnover before the split
+        week: (SparkDataframe) filtered weeks
+        current_week: (int) current week id
+        bucket: (string) refined S3 bucket
+        path_refined_global: (string) prefix of the refined tables
+        run_id: (string) id of the current run
+        models_per_shard: (int) number of models (rows) per shard
+
+    Returns:
+        object: (dict) the metadata of the export
+    """
+    path = path_refined_global + MATRIX_DIR + run_id + '/'
+    # Remove a partial export of a previous attempt of the run, which may have more shards
+    fs, hadoop_path = ut.get_hadoop_path(spark, bucket, path)
+    if fs.exists(hadoop_path):
+        fs.delete(hadoop_path, True)
+
+    week_index = get_week_index(week, current_week)
+    model_index = get_model_index(model_week_sales)
+    channels = sorted([c['channel'] for c in model_week_sales.select('channel').distinct().collect()])
+    write_npy(spark, bucket, path + 'model_index.npy', model_index)
+    write_npy(spark, bucket, path + 'week_index.npy', week_index)
+
+    cells = get_cells(spark, model_week_sales, model_index, week_index)
+    shard_files = get_shard_files(cells, len(model_index), len(week_index), channels, models_per_shard)
+    files = {}
+    # One partition (a shard, or a few) of the files collected at a time
+    for shard_file in shard_files.toLocalIterator():
+        shard_name = 'shard_{:05d}'.format(shard_file['shard_id'])
+        ut.spark_write_bytes_s3(spark, bucket, path + shard_name + '/' + shard_file['name'] + '.npy',
+                                bytes(shard_file['data']))
+        files.setdefault(shard_file['shard_id'], []).append(shard_file['name'] + '.npy')
+        print('[model_week_matrix] {}/{}.npy written, {} cells'.format(shard_name, shard_file['name'],
+                                                                      shard_file['nb_cells']))
+
+    shards = []
+    for shard_id, model_from in enumerate(range(0, len(model_index), models_per_shard)):
+        shards.append({'name': 'shard_{:05d}'.format(shard_id), 'model_from': model_from,
+                       'model_to': min(model_from + models_per_shard, len(model_index)),
+                       'files': sorted(files.get(shard_id, []))})
+
+    metadata = {
+        'run_id': run_id,
+        'directory': run_id + '/',
+        'dtype': 'float32',
+        'nb_models': len(model_index),
+        'nb_weeks': len(week_index),
+        'channels': channels,
+        'fill_values': {measure: str(fill_value) for measure, fill_value in MEASURES.items()},
+        'shards': shards,
+    }
+    content = json.dumps(metadata, indent=2)
+    ut.spark_write_text_s3(spark, bucket, path + 'metadata.json', content)
+    previous = ut.spark_read_text_s3(spark, bucket, path_refined_global + MATRIX_DIR + 'latest.json')
+    ut.spark_write_text_s3(spark, bucket, path_refined_global + MATRIX_DIR + 'latest.json', content)
+    kept_runs = [run_id] + ([json.loads(previous)['run_id']] if previous else [])
+    remove_older_exports(spark, bucket, path_refined_global + MATRIX_DIR, kept_runs)
+    return metadata
+
+
+def remove_older_exports(spark, bucket, path_matrix, kept_runs):
+    """
+    Remove the exports older than the latest & the previous ones, once latest.json points to the latest one:
+    the previous export is kept for the jobs which read it before the switch
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) refined S3 bucket
+        path_matrix: (string) full path to the matrix directory within the S3 bucket
+        kept_runs: (list) ids of the runs whose export is kept
+    """
+    fs, hadoop_path = ut.get_hadoop_path(spark, bucket, path_matrix)
+    for status in fs.listStatus(hadoop_path):
+        if status.isDirectory() and status.getPath().getName() not in kept_runs:
+            fs.delete(status.getPath(), True)
@@ -3,9 +3,12 @@ import time
 import src.tools.utils as ut
 
 import pyspark.sql.functions as F
+from pyspark.sql import Window
 from pyspark.sql.types import *
 from pyspark import StorageLevel
 
+from stages import stage
+
 
 def get_sku_mrp_apo(gdw, sapb, sku):
     """
@@ -20,7 +23,7 @@ def get_sku_mrp_apo(gdw, sapb, sku):
         .join(sku,
               on=sku['sku_num_sku_r3'] == F.regexp_replace(gdw['sdw_material_id'], '^0*|\s', ''),
               how='inner') \
-        .join(F.broadcast(sapb),
+        .join(sapb,
               on=gdw['sdw_plant_id'] == sapb['plant_id'],
               how='inner') \
         .filter(F.current_timestamp().between(sku['sku_date_begin'], sku['sku_date_end'])) \
@@ -33,10 +36,48 @@ def get_sku_mrp_apo(gdw, sapb, sku):
     return smu
 
 
+def get_model_mrp_intervals_apo(smu, day, whitelist):
+    """
+    Get the MRP status intervals of each model, as disjoint intervals of days.
+    The bounds are first mapped on the days they cover (with the same comparisons as a day by day join),
+    for the few distinct dates only, then the sku intervals are coalesced by model.
+
+    Args:
+        smu:
+        day: days since 201939
+        whitelist:
+    """
+    begin_day = smu.select('date_begin').distinct()
+    begin_day = begin_day \
+        .join(day, on=day['day_id_day'] >= begin_day['date_begin'], how='inner') \
+        .groupBy(begin_day['date_begin']) \
+        .agg(F.min(day['day_id_day']).alias('begin'))
+    end_day = smu.select('date_end').distinct()
+    end_day = end_day \
+        .join(day, on=day['day_id_day'] <= end_day['date_end'], how='inner') \
+        .groupBy(end_day['date_end']) \
+        .agg(F.max(day['day_id_day']).alias('end'))
+
+    intervals = smu \
+        .join(begin_day, on=['date_begin'], how='inner') \
+        .join(end_day, on=['date_end'], how='inner') \
+        .filter(F.col('begin') <= F.col('end')) \
+        .select(smu['model_id'],
+                F.col('begin'),
+                F.col('end'),
+                F.when(smu['mrp'].isin(2, 5) | smu['model_id'].isin(whitelist), True).otherwise(False)
+                .alias('is_active'))
+
+    model_mrp_apo = ut.coalesce_intervals(intervals, ['model_id'], lambda point: F.date_add(point, 1))
+    return model_mrp_apo
+
+
 def get_model_week_mrp_apo(gdw, sapb, sku, day, whitelist):
     """
     Calculate model week MRP from APO
     add the filter of whitelist.
+    Only the coalesced intervals of each model are expanded on weeks, a week is active
+    if one of its days is active.
 
     Args:
         gdw:
@@ -45,15 +86,20 @@ def get_model_week_mrp_apo(gdw, sapb, sku, day, whitelist):
         day:
     """
     smu = get_sku_mrp_apo(gdw, sapb, sku)
-
-    model_week_mrp_apo = smu \
-        .join(F.broadcast(day),
-              on=day['day_id_day'].between(smu['date_begin'], smu['date_end']),
+    day = day.filter(day['wee_id_week'] >= '201939')
+    model_mrp_apo = get_model_mrp_intervals_apo(smu, day, whitelist)
+
+    week_days = day \
+        .groupBy(day['wee_id_week']) \
+        .agg(F.min(day['day_id_day']).alias('first_day'),
+             F.max(day['day_id_day']).alias('last_day'))
+    model_week_mrp_apo = model_mrp_apo \
+        .join(week_days,
+              on=(model_mrp_apo['begin'] <= week_days['last_day']) &
+                 (model_mrp_apo['end_excluded'] > week_days['first_day']),
               how='inner') \
-        .filter(day['wee_id_week'] >= '201939') \
-        .groupBy(day['wee_id_week'].cast('int').alias('week_id'), smu['model_id']) \
-        .agg(F.max(F.when(smu['mrp'].isin(2, 5) | smu['model_id'].isin(whitelist), True).otherwise(False)).alias('is_mrp_active')) \
-        .orderBy('model_id', 'week_id')
+        .groupBy(week_days['wee_id_week'].cast('int').alias('week_id'), model_mrp_apo['model_id']) \
+        .agg(F.max(model_mrp_apo['is_active']).alias('is_mrp_active'))
     return model_week_mrp_apo
 
 
@@ -132,40 +178,73 @@ def get_sku_mrp_pf(sku_migrated_pf, mrp_status_pf, sku):
     return sku_mrp_pf
 
 
-def get_sku_week_mrp_pf(sku_mrp_pf, week):
+def get_pf_weeks(week):
     """
-    Get mrp data week by week
+    Get the weeks with their rank, so that consecutive weeks have consecutive indexes (201952 is followed by 202001)
 
     Args:
-        sku_mrp_pf:
-        week:
+        week: filtered weeks
     """
-    sku_week_mrp_pf = week \
-        .join(sku_mrp_pf,
-              on=week['wee_id_week'].between(F.col('week_from'), F.col('week_to')),
-              how='inner') \
-        .select(sku_mrp_pf['purch_org'],
-                sku_mrp_pf['mdl_num_model_r3'].alias('model_id'),
-                week['wee_id_week'].cast('int').alias('week_id'),
-                sku_mrp_pf['mrp_status'])
+    pf_weeks = week \
+        .select(week['wee_id_week'].cast('int').alias('week_id')) \
+        .distinct() \
+        .withColumn('week_idx', F.row_number().over(Window.orderBy('week_id')))
+    return pf_weeks
 
-    return sku_week_mrp_pf
 
-
-def get_active_model_week_mrp_pf(sku_week_mrp_pf, list_active_mrp):
+def get_model_mrp_intervals_pf(sku_mrp_pf, pf_weeks, list_active_mrp):
     """
+    Get the MRP status intervals of each model, as disjoint intervals of week indexes.
+    The bounds are first mapped on the indexes of the weeks they cover, for the few distinct bounds only,
+    so that intervals meeting at a year end are merged. A null status stays unknown, unless another status
+    covers the week.
 
     Args:
-        sku_week_mrp_pf:
+        sku_mrp_pf:
+        pf_weeks: output of get_pf_weeks
         list_active_mrp:
+    """
+    begin_week = sku_mrp_pf.select('week_from').distinct()
+    begin_week = begin_week \
+        .join(pf_weeks, on=pf_weeks['week_id'] >= begin_week['week_from'], how='inner') \
+        .groupBy(begin_week['week_from']) \
+        .agg(F.min(pf_weeks['week_idx']).alias('begin'))
+    end_week = sku_mrp_pf.select('week_to').distinct()
+    end_week = end_week \
+        .join(pf_weeks, on=pf_weeks['week_id'] <= end_week['week_to'], how='inner') \
+        .groupBy(end_week['week_to']) \
+        .agg(F.max(pf_weeks['week_idx']).alias('end'))
+
+    intervals = sku_mrp_pf \
+        .join(begin_week, on=['week_from'], how='inner') \
+        .join(end_week, on=['week_to'], how='inner') \
+        .filter(F.col('begin') <= F.col('end')) \
+        .select(F.col('mdl_num_model_r3').alias('model_id'),
+                F.col('begin'),
+                F.col('end'),
+                F.col('mrp_status').isin(list_active_mrp).alias('is_active'))
+
+    model_mrp_pf = ut.coalesce_intervals(intervals, ['model_id'], lambda point: point + 1)
+    return model_mrp_pf
+
+
+def get_active_model_week_mrp_pf(model_mrp_pf, pf_weeks):
+    """
+    Get mrp data week by week.
+    The intervals of a model are disjoint, so each model week is created once.
 
-    Returns:
-
+    Args:
+        model_mrp_pf:
+        pf_weeks: output of get_pf_weeks
     """
-    model_week_mrp_pf = sku_week_mrp_pf \
-        .withColumn('is_mrp_active', sku_week_mrp_pf['mrp_status'].isin(list_active_mrp)) \
-        .groupBy('model_id', 'week_id') \
-        .agg(F.max(F.col('is_mrp_active')).alias('is_mrp_active'))
+    model_week_mrp_pf = pf_weeks \
+        .join(model_mrp_pf,
+              on=(pf_weeks['week_idx'] >= model_mrp_pf['begin']) &
+                 (pf_weeks['week_idx'] < model_mrp_pf['end_excluded']),
+              how='inner') \
+        .select(model_mrp_pf['model_id'],
+                pf_weeks['week_id'],
+                model_mrp_pf['is_active'].alias('is_mrp_active'))
 
     return model_week_mrp_pf
 
@@ -187,12 +266,15 @@ def get_model_week_mrp_pf(sms, zep, week, sku):
     sku_migrated_pf = get_migrated_sku_pf(zep)
 
     sku_mrp_pf = get_sku_mrp_pf(mrp_status_pf, sku_migrated_pf, sku)
-    sku_week_mrp_pf = get_sku_week_mrp_pf(sku_mrp_pf, week)
-    model_week_mrp_pf = get_active_model_week_mrp_pf(sku_week_mrp_pf, list_active_mrp)
+    pf_weeks = get_pf_weeks(week)
+    model_mrp_pf = get_model_mrp_intervals_pf(sku_mrp_pf, pf_weeks, list_active_mrp)
+    model_week_mrp_pf = get_active_model_week_mrp_pf(model_mrp_pf, pf_weeks)
 
     return model_week_mrp_pf
 
 
+@stage('model_week_mrp', inputs=['gdw', 'sapb', 'sku', 'day', 'sms', 'zep', 'week'], upstream=['model_week_sales'],
+       outputs=['model_week_mrp'])
 def get_model_week_mrp(gdw, sapb, sku, day, sms, zep, week, white_list, first_backtesting_cutoff):
     """
 
@@ -219,6 +301,27 @@ def get_model_week_mrp(gdw, sapb, sku, day, sms, zep, week, white_list, first_ba
     ut.get_timer(starting_time=start)
     print('[model_week_mrp] length:', model_week_mrp_apo_count)
 
+    model_week_mrp = merge_model_week_mrp(model_week_mrp_apo, sms, zep, week, sku, first_backtesting_cutoff)
+    return model_week_mrp
+
+
+def merge_model_week_mrp(model_week_mrp_apo, sms, zep, week, sku, first_backtesting_cutoff):
+    """
+    Complete the model week MRP from APO (computed globally or merged from shards)
+    with the MRP from Purchase Forecast of the migrated models.
+
+    Args:
+        model_week_mrp_apo:
+        sms:
+        zep:
+        week:
+        sku:
+        first_backtesting_cutoff:
+
+    Returns:
+
+    """
+    model_week_mrp_apo_clean = model_week_mrp_apo
     if first_backtesting_cutoff < 201939:
         # Fill missing MRP for APO
         print('====> Filling missing MRP for APO...')
@@ -231,8 +334,6 @@ def get_model_week_mrp(gdw, sapb, sku, day, sms, zep, week, white_list, first_ba
     # Join between MRP APO and Purchase Forecast
     print('====> Join between MRP APO and Purchase Forecast...')
     model_not_migrate_pf = model_week_mrp_apo_clean.join(model_week_mrp_pf, on=['model_id', 'week_id'], how='leftanti')
-    model_week_mrp = model_week_mrp_pf \
-        .union(model_not_migrate_pf) \
-        .orderBy('model_id', 'week_id')
+    model_week_mrp = model_week_mrp_pf.union(model_not_migrate_pf)
 
     return model_week_mrp
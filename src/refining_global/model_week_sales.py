@@ -2,151 +2,222 @@ import pyspark.sql.functions as F
 import src.tools.utils as ut
 import datetime
 
+from pyspark import StorageLevel
 
-def get_offline_sales(tdt, day, week, sku, but, cex, sapb, taiwan):
-    """
-    1.Get Offline sales from transactions data
-        but['but_num_typ_but'] == 7 physical store
-        tdt['the_to_type']) == 'offline'
-    2.Delete the product that taiwan by from other way:
-        ~((sku['mdl_num_model_r3'].isin(taiwan)) & (sapb['purch_org'] == 'Z024'))
-    3.Add a column for channel:
-        .withColumn("channel", F.lit('offline'))
-    """
-    offline_sales = tdt \
-        .join(F.broadcast(day),
-              on=F.to_date(tdt['tdt_date_to_ordered'], 'yyyy-MM-dd') == day['day_id_day'],
-              how='inner') \
-        .join(F.broadcast(week),
-              on=week['wee_id_week'] == day['wee_id_week'],
-              how='inner') \
-        .join(sku,
-              on=sku['sku_idr_sku'] == tdt['sku_idr_sku'],
-              how='inner') \
-        .join(F.broadcast(but.filter(but['but_num_typ_but'] == 7)),
-              on=but['but_idr_business_unit'] == tdt['but_idr_business_unit'],
-              how='inner') \
-        .join(F.broadcast(cex),
-              on=tdt['cur_idr_currency'] == cex['cur_idr_currency'],
-              how='left') \
-        .join(F.broadcast(sapb),
-              on=but['but_num_business_unit'].cast('string') == F.regexp_replace(sapb['plant_id'], '^0*|\s', ''),
-              how='inner') \
-        .filter(F.lower(tdt['the_to_type']) == 'offline') \
-        .filter(~((sku['mdl_num_model_r3'].isin(taiwan)) & (sapb['purch_org'] == 'Z024'))) \
-        .select(sku['mdl_num_model_r3'].alias('model_id'),
-                day['wee_id_week'].cast('int').alias('week_id'),
-                week['day_first_day_week'].alias('date'),
-                but['but_idr_business_unit'],
-                tdt['f_qty_item'],
-                tdt['f_pri_regular_sales_unit'],
-                tdt['f_to_tax_in'],
-                cex['exchange_rate']) \
-        .withColumn("channel", F.lit('offline'))\
-        .cache()
-    return offline_sales
-
-
-def get_online_sales(dyd, day, week, sku, but, gdc, cex, sapb, channel, taiwan):
-    """
-    1.Get online sales from delivery data:
-        .dyd['tdt_type_detail'] == 'sale'
-        .dyd['the_to_type'] == 'online'
-    2. Get data from non-canceled:
-        . dyd['the_transaction_status'] != 'canceled'
-    3.Delete the product that taiwan by from other way:
-        ~((sku['mdl_num_model_r3'].isin(taiwan)) & (sapb['purch_org'] == 'Z024'))
-    4.Add a column for channel:
-        .withColumn("channel", F.lit('offline'))
-    """
-    online_sales = dyd \
-        .join(F.broadcast(day),
-              on=F.to_date(dyd['tdt_date_to_ordered'], 'yyyy-MM-dd') == day['day_id_day'],
-              how='inner') \
-        .join(F.broadcast(week),
-              on=week['wee_id_week'] == day['wee_id_week'],
-              how='inner') \
-        .join(sku,
-              on=sku['sku_idr_sku'] == dyd['sku_idr_sku'],
-              how='inner') \
-        .join(F.broadcast(but),
-              on=dyd['but_idr_business_unit_stock_origin'] == but['but_idr_business_unit'],
-              how='inner') \
-        .join(F.broadcast(gdc),
-              on=but['but_code_international'] == F.concat(gdc['ean_1'], gdc['ean_2'], gdc['ean_3']),
-              how='inner') \
-        .join(F.broadcast(cex),
-              on=cex['cur_idr_currency'] == dyd['cur_idr_currency'],
-              how='left') \
-        .join(F.broadcast(sapb),
-              on=sapb['plant_id'] == gdc['plant_id'],
-              how='inner') \
-        .filter(F.lower(dyd['the_to_type']) == 'online') \
-        .filter(F.lower(dyd['tdt_type_detail']) == 'sale') \
-        .filter(dyd['the_transaction_status'] != 'canceled') \
-        .filter(~((sku['mdl_num_model_r3'].isin(taiwan)) & (sapb['purch_org'] == 'Z024'))) \
-        .select(sku['mdl_num_model_r3'].alias('model_id'),
-                day['wee_id_week'].cast('int').alias('week_id'),
-                week['day_first_day_week'].alias('date'),
-                but['but_idr_business_unit'],
-                dyd['f_qty_item'],
-                dyd['f_tdt_pri_regular_sales_unit'].alias('f_pri_regular_sales_unit'),
-                dyd['f_to_tax_in'],
-                cex['exchange_rate']) \
-        .withColumn("channel", F.lit('online'))\
-        .cache()
-    return online_sales
+from stages import stage
+import fact_sources as fs
+import store_sketch as sketch
+
+# Keys of the base aggregate (the cube): every sales output is a roll-up of it on a subset of its keys.
+# week_id & date only depend on the day, they are kept to roll up without joining the days again.
+CUBE_KEYS = ['model_id', 'week_id', 'date', 'day_id', 'but_idr_business_unit', 'channel']
+
+# Channel of the store sketches of all the channels together
+SKETCH_ALL_CHANNELS = 'all'
 
-def union_sales(offline_sales, online_sales, current_week, group_item):
+
+def get_sales_partials(sales, keys):
+    """
+    Aggregate sales lines into mergeable partial aggregates for each keys:
+     - sales_quantity: sum of quantities
+     - sum_price & count_price: sum & count of regular sales unit with exchange (their ratio is the mean)
+     - sum_turnover: sum taxes with exchange
     """
-    union online and offline sales and compute metrics for each (model, date)
+    price = F.col('f_pri_regular_sales_unit') * F.col('exchange_rate')
+    sales_partials = sales \
+        .groupby(keys) \
+        .agg(F.sum('f_qty_item').alias('sales_quantity'),
+             F.sum(price).alias('sum_price'),
+             F.count(price).alias('count_price'),
+             F.sum(F.col('f_to_tax_in') * F.col('exchange_rate')).alias('sum_turnover'))
+    return sales_partials
+
+
+def merge_sales_partials(sales_partials, keys):
+    """
+    Merge partial aggregates on coarser keys (or coming from several shards)
+    """
+    sales_partials = sales_partials \
+        .groupby(keys) \
+        .agg(F.sum('sales_quantity').alias('sales_quantity'),
+             F.sum('sum_price').alias('sum_price'),
+             F.sum('count_price').alias('count_price'),
+             F.sum('sum_turnover').alias('sum_turnover'))
+    return sales_partials
+
+
+def finalize_sales(sales_partials, current_week):
+    """
+    Compute the metrics from the partial aggregates and keep the positive ones of the past weeks
      - quantity: online quantity + offline quantities
      - average_price: mean of regular sales unit
      - turnover: sum taxes with exchange
     """
-    model_week_sales = offline_sales.union(online_sales) \
-        .groupby(['model_id', 'week_id'] + group_item) \
-        .agg(F.sum('f_qty_item').alias('sales_quantity'),
-             F.mean(F.col('f_pri_regular_sales_unit') * F.col('exchange_rate')).alias('average_price'),
-             F.sum(F.col('f_to_tax_in') * F.col('exchange_rate')).alias('sum_turnover')) \
+    measures = ['sales_quantity', 'sum_price', 'count_price', 'sum_turnover']
+    keys = [c for c in sales_partials.columns if c not in measures]
+    model_week_sales = sales_partials \
+        .select(*keys,
+                F.col('sales_quantity'),
+                (F.col('sum_price') / F.col('count_price')).alias('average_price'),
+                F.col('sum_turnover')) \
         .filter(F.col('sales_quantity') > 0) \
         .filter(F.col('average_price') > 0) \
         .filter(F.col('sum_turnover') > 0) \
-        .filter(F.col('week_id') < current_week) \
-        .orderBy('model_id', 'week_id')\
-        .cache()
+        .filter(F.col('week_id') < current_week)
     return model_week_sales
 
 
-def but_unit_number(offline_sales, online_sales, current_week, bucket_refined, but_path, but_week):
+def get_sales_cube(sales_lines):
+    """
+    Aggregate the sales lines of all the channels once, into partial aggregates at the finest grain needed:
+    (model, day, store, channel). The raw sales lines are only read here.
+    """
+    sales_cube = get_sales_partials(sales_lines, CUBE_KEYS) \
+        .persist(StorageLevel.MEMORY_AND_DISK)
+    return sales_cube
+
+
+def rollup_sales(sales_cube, keys, current_week):
+    """
+    Roll up the cube (or any partial aggregates at a finer grain) on some of its keys and compute the metrics,
+    e.g. ['model_id', 'week_id', 'but_idr_business_unit'] for the store level sales
+    or ['model_id', 'day_id', 'channel'] for the daily sales.
+    """
+    return finalize_sales(merge_sales_partials(sales_cube, keys), current_week)
+
+
+def get_week_store_sketches(sales_cube, weeks, current_week, precision):
+    """
+    Build the store sketches of some weeks from the cube: by channel, and for all the channels (SKETCH_ALL_CHANNELS)
+    from the stores whose sales summed over the channels are positive, the rule of the exact count
+    """
+    week_cube = sales_cube.filter(F.col('week_id').isin(weeks))
+    keys = ['model_id', 'week_id', 'channel']
+    channel_sales = rollup_sales(week_cube, ['model_id', 'week_id', 'channel', 'but_idr_business_unit'], current_week)
+    store_sales = rollup_sales(week_cube, ['model_id', 'week_id', 'but_idr_business_unit'], current_week) \
+        .withColumn('channel', F.lit(SKETCH_ALL_CHANNELS))
+    return sketch.get_store_sketches(channel_sales, keys, precision) \
+        .union(sketch.get_store_sketches(store_sales, keys, precision)) \
+        .withColumn('precision', F.lit(precision))
+
+
+def update_store_sketches(sales_cube, current_week, bucket_refined, but_path, store_count_params):
+    """
+    Update the persisted store sketches of each model, week & channel: only the sketches of the last rebuild_weeks
+    weeks (late corrections of the sales) and of the weeks not persisted yet are built from the cube, the sketches
+    of the other weeks are read back.
+    """
+    spark = sales_cube.sql_ctx.sparkSession
+    precision = store_count_params['precision']
+    path = f'{but_path}fcst_bi_store_sketch'
+    cube_weeks = [int(w[0]) for w in sales_cube.filter(F.col('week_id') < current_week)
+                  .select('week_id').distinct().collect()]
+    first_rebuilt_week = ut.get_shift_n_week(current_week, -store_count_params['rebuild_weeks'])
+
+    persisted, kept_weeks = None, []
+    fs, hadoop_path = ut.get_hadoop_path(spark, bucket_refined, path)
+    if fs.exists(hadoop_path):
+        persisted = ut.spark_read_parquet_s3(spark, bucket_refined, path)
+        # Sketches of another precision (or without it) cannot be merged with the new ones
+        if 'precision' in persisted.columns:
+            persisted = persisted \
+                .filter((F.col('precision') == precision) & (F.col('week_id') < first_rebuilt_week) &
+                        F.col('week_id').isin(cube_weeks))
+            kept_weeks = [int(w[0]) for w in persisted.select('week_id').distinct().collect()]
+    new_weeks = sorted(set(cube_weeks) - set(kept_weeks))
+    print('[store sketches] {} weeks read back, {} weeks built'.format(len(kept_weeks), len(new_weeks)))
+
+    store_sketches = get_week_store_sketches(sales_cube, new_weeks, current_week, precision)
+    if kept_weeks:
+        store_sketches = persisted.select(store_sketches.columns).union(store_sketches)
+    # Materialized before overwriting the persisted sketches it reads
+    store_sketches = store_sketches.persist(StorageLevel.MEMORY_AND_DISK)
+    store_sketches.count()
+    ut.spark_write_parquet_s3(store_sketches, bucket_refined, path)
+    return store_sketches
+
+
+def get_sketch_store_counts(store_sketches, week, precision, rolling_weeks):
+    """
+    Count the stores selling each model in the week, and in the rolling weeks ending with the week,
+    by merging the store sketches of all the channels of the weeks
+    """
+    store_sketches = store_sketches.filter(F.col('channel') == SKETCH_ALL_CHANNELS)
+    store_counts = sketch.estimate_distinct(store_sketches.filter(F.col('week_id') == week),
+                                            ['model_id', 'week_id'], precision, 'num_store_following')
+    for nb_weeks in rolling_weeks:
+        weeks = [ut.get_shift_n_week(week, -n) for n in range(nb_weeks)]
+        rolling_counts = sketch.estimate_distinct(store_sketches.filter(F.col('week_id').isin(weeks)),
+                                                  ['model_id'], precision, f'num_store_following_{nb_weeks}w')
+        store_counts = store_counts.join(rolling_counts, on=['model_id'], how='left')
+    return store_counts
+
+
+def write_but_unit_number(sales, current_week, bucket_refined, but_path, but_week, store_sketches=None,
+                          store_count_params=None):
+    """
+    Write the BI dynamic features (number of stores selling each model & their average price)
+    of the requested weeks from the store level sales.
+    With store sketches, the number of stores is estimated from the sketches, with the rolling counts.
+    """
     shifted_date = datetime.datetime.strptime(str(current_week) + "1", "%G%V%u") + datetime.timedelta(weeks=-1)
     but_weeks = but_week + [ut.date_to_week_id(shifted_date)]
-    sales = union_sales(offline_sales, online_sales, current_week, ['but_idr_business_unit'])
     for week in but_weeks:
         if week < current_week:
-            but = sales \
-                .filter(sales.week_id == week) \
-                .groupby(['model_id', 'week_id']) \
-                .agg({'but_idr_business_unit': 'count', 'average_price': 'mean'}) \
-                .select(F.col('model_id'), F.col('week_id'),
-                        F.col('avg(average_price)').alias('weekly_average_price'),
-                        F.col('count(but_idr_business_unit)').alias('num_store_following')) \
+            if store_sketches is None:
+                but = sales \
+                    .filter(sales.week_id == week) \
+                    .groupby(['model_id', 'week_id']) \
+                    .agg({'but_idr_business_unit': 'count', 'average_price': 'mean'}) \
+                    .select(F.col('model_id'), F.col('week_id'),
+                            F.col('avg(average_price)').alias('weekly_average_price'),
+                            F.col('count(but_idr_business_unit)').alias('num_store_following'))
+            else:
+                but = sales \
+                    .filter(sales.week_id == week) \
+                    .groupby(['model_id', 'week_id']) \
+                    .agg(F.mean('average_price').alias('weekly_average_price')) \
+                    .join(get_sketch_store_counts(store_sketches, week, store_count_params['precision'],
+                                                  store_count_params['rolling_weeks']),
+                          on=['model_id', 'week_id'], how='inner')
+            but = but \
                 .withColumn('update_time', F.current_timestamp()) \
                 .orderBy(['model_id', 'week_id'], ascending=True)\
                 .cache()
             ut.spark_write_csv_s3(but, bucket_refined, f'{but_path}fcst_bi_dynamic_feat/{week}')
 
 
-def get_model_week_sales(tdt, dyd, day, week, sku, but, cex, sapb, gdc, current_week,
-                         taiwan, channel, bucket_refined, but_path, but_week):
-    # Get offline sales
-    offline_sales = get_offline_sales(tdt, day, week, sku, but, cex, sapb, taiwan)
-    # Get online sales
-    online_sales = get_online_sales(dyd, day, week, sku, but, gdc, cex, sapb, channel, taiwan)
-
-    print("=======create BI table fcswt_bi_dynamic_feat========")
-    but_unit_number(offline_sales, online_sales, current_week, bucket_refined, but_path, but_week)
+def get_model_week_sales_from_cube(sales_cube, current_week, bucket_refined, but_path, but_week, write_bi=True,
+                                   store_count_params=None):
+    """
+    Create the BI table & model week sales by roll-ups of the sales cube (computed here or merged from shards)
+    """
+    if write_bi:
+        print("=======create BI table fcswt_bi_dynamic_feat========")
+        store_sales = rollup_sales(sales_cube, ['model_id', 'week_id', 'but_idr_business_unit'], current_week)
+        store_sketches = None
+        if store_count_params and store_count_params['mode'] == 'sketch':
+            # Store sketches by model, week & channel, persisted to be merged on other weeks or channels
+            store_sketches = update_store_sketches(sales_cube, current_week, bucket_refined, but_path,
+                                                   store_count_params)
+        write_but_unit_number(store_sales, current_week, bucket_refined, but_path, but_week, store_sketches,
+                              store_count_params)
 
     print("=======Create model week sales========")
-    model_week_sales = union_sales(offline_sales, online_sales, current_week, ['date', 'channel'])
+    model_week_sales = rollup_sales(sales_cube, ['model_id', 'week_id', 'date', 'channel'], current_week) \
+        .orderBy('model_id', 'week_id')\
+        .cache()
     return model_week_sales
+
+
+@stage('model_week_sales', inputs=fs.get_input_tables(), upstream=[],
+       outputs=['model_week_sales', 'model_week_price', 'model_week_turnover'])
+def get_model_week_sales(tables, current_week, taiwan, bucket_refined, but_path, but_week, write_bi=True,
+                         store_count_params=None):
+    # Get the sales lines of all the channels, joined with the dimensions once
+    sales_lines = fs.get_sales_lines(fs.get_fact_lines(tables), tables, taiwan)
+
+    print("=======Aggregate sales cube========")
+    sales_cube = get_sales_cube(sales_lines)
+    return get_model_week_sales_from_cube(sales_cube, current_week, bucket_refined, but_path, but_week, write_bi,
+                                          store_count_params)
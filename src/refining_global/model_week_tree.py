@@ -1,26 +1,154 @@
+from functools import reduce
+
 import pyspark.sql.functions as F
+from pyspark.sql import Window
 
+from stages import stage
 
-def get_model_week_tree(sku_h, week, first_backtesting_cutoff):
-    model_week_tree = sku_h \
-        .join(F.broadcast(week.filter(week['wee_id_week'] >= first_backtesting_cutoff)),
-              on=week['day_first_day_week'].between(sku_h['sku_date_begin'], sku_h['sku_date_end']),
+
+TREE_ATTRIBUTES = ['family_id', 'sub_department_id', 'department_id', 'univers_id', 'product_nature_id',
+                   'model_label', 'family_label', 'sub_department_label', 'department_label', 'univers_label',
+                   'product_nature_label', 'brand_label', 'brand_type']
+
+
+def get_tree_weeks(week, first_backtesting_cutoff):
+    """
+    Get the weeks of the tree with their rank, so that consecutive weeks have consecutive indexes
+
+    Args:
+        week:
+        first_backtesting_cutoff:
+    """
+    tree_weeks = week \
+        .filter(week['wee_id_week'] >= first_backtesting_cutoff) \
+        .select(week['wee_id_week'].cast('int').alias('week_id'),
+                week['day_first_day_week']) \
+        .withColumn('week_idx', F.row_number().over(Window.orderBy('week_id')))
+    return tree_weeks
+
+
+def get_sku_week_intervals(sku_h, tree_weeks):
+    """
+    Map the validity dates of each sku version on the indexes of the weeks it covers
+    (a week is covered if its first day is within the validity dates).
+    The comparisons are only made for the few distinct dates, not for every sku version.
+
+    Args:
+        sku_h:
+        tree_weeks:
+    """
+    begin_week = sku_h.select('sku_date_begin').distinct()
+    begin_week = begin_week \
+        .join(tree_weeks, on=tree_weeks['day_first_day_week'] >= begin_week['sku_date_begin'], how='inner') \
+        .groupBy(begin_week['sku_date_begin']) \
+        .agg(F.min(tree_weeks['week_idx']).alias('from_idx'))
+    end_week = sku_h.select('sku_date_end').distinct()
+    end_week = end_week \
+        .join(tree_weeks, on=tree_weeks['day_first_day_week'] <= end_week['sku_date_end'], how='inner') \
+        .groupBy(end_week['sku_date_end']) \
+        .agg(F.max(tree_weeks['week_idx']).alias('to_idx'))
+
+    sku_week_intervals = sku_h \
+        .join(begin_week, on=['sku_date_begin'], how='inner') \
+        .join(end_week, on=['sku_date_end'], how='inner') \
+        .filter(F.col('from_idx') <= F.col('to_idx')) \
+        .select(sku_h['mdl_num_model_r3'].alias('model_id'),
+                F.col('from_idx'),
+                F.col('to_idx'),
+                sku_h['fam_num_family'].alias('family_id'),
+                sku_h['sdp_num_sub_department'].alias('sub_department_id'),
+                sku_h['dpt_num_department'].alias('department_id'),
+                sku_h['unv_num_univers'].alias('univers_id'),
+                sku_h['pnt_num_product_nature'].alias('product_nature_id'),
+                F.when(sku_h['mdl_label'].isNull(), 'UNKNOWN').otherwise(sku_h['mdl_label']).alias('model_label'),
+                sku_h['family_label'].alias('family_label'),
+                sku_h['sdp_label'].alias('sub_department_label'),
+                sku_h['dpt_label'].alias('department_label'),
+                sku_h['unv_label'].alias('univers_label'),
+                F.when(sku_h['product_nature_label'].isNull(), 'UNDEFINED')
+                .otherwise(sku_h['product_nature_label']).alias('product_nature_label'),
+                sku_h['brd_label_brand'].alias('brand_label'),
+                sku_h['brd_type_brand_libelle'].alias('brand_type'))
+    return sku_week_intervals
+
+
+@stage('model_week_tree', inputs=['sku_h', 'week'], upstream=['model_week_sales'],
+       outputs=['model_tree_history', 'model_week_tree'])
+def get_model_tree_history(sku_h, week, first_backtesting_cutoff):
+    """
+    Get the tree of each model as change intervals (SCD2):
+    model_tree_history(model_id, valid_from_week, valid_to_week, attributes...)
+        1. the validity bounds of the sku versions split the timeline of each model in elementary intervals
+        2. the attributes of an interval are the max of the sku versions covering it
+        3. consecutive intervals with the same attributes are merged
+    Expanded on weeks, it is exactly the former model_week_tree.
+
+    Args:
+        sku_h:
+        week:
+        first_backtesting_cutoff:
+    """
+    tree_weeks = get_tree_weeks(week, first_backtesting_cutoff)
+    sku_week_intervals = get_sku_week_intervals(sku_h, tree_weeks)
+
+    timeline = Window.partitionBy('model_id').orderBy('begin_idx')
+    bounds = sku_week_intervals.select('model_id', F.col('from_idx').alias('begin_idx')) \
+        .union(sku_week_intervals.select('model_id', (F.col('to_idx') + 1).alias('begin_idx'))) \
+        .distinct() \
+        .withColumn('end_idx', F.lead('begin_idx').over(timeline)) \
+        .filter(F.col('end_idx').isNotNull())
+
+    model_intervals = sku_week_intervals \
+        .join(bounds, on=['model_id'], how='inner') \
+        .filter((F.col('from_idx') <= F.col('begin_idx')) & (F.col('to_idx') >= F.col('begin_idx'))) \
+        .groupBy('model_id', 'begin_idx', 'end_idx') \
+        .agg(*[F.max(c).alias(c) for c in TREE_ATTRIBUTES])
+
+    # Merge the consecutive intervals with the same attributes
+    is_same = reduce(lambda c1, c2: c1 & c2,
+                     [F.lag(c).over(timeline).eqNullSafe(F.col(c)) for c in TREE_ATTRIBUTES] +
+                     [F.lag('end_idx').over(timeline) == F.col('begin_idx')])
+    model_intervals = model_intervals \
+        .withColumn('is_new', F.coalesce(~is_same, F.lit(True))) \
+        .withColumn('change_id', F.sum(F.col('is_new').cast('int'))
+                    .over(timeline.rowsBetween(Window.unboundedPreceding, Window.currentRow))) \
+        .groupBy('model_id', 'change_id') \
+        .agg(F.min('begin_idx').alias('begin_idx'),
+             F.max('end_idx').alias('end_idx'),
+             *[F.first(c).alias(c) for c in TREE_ATTRIBUTES])
+
+    valid_from = tree_weeks.select(F.col('week_idx').alias('begin_idx'), F.col('week_id').alias('valid_from_week'))
+    valid_to = tree_weeks.select((F.col('week_idx') + 1).alias('end_idx'), F.col('week_id').alias('valid_to_week'))
+    model_tree_history = model_intervals \
+        .join(F.broadcast(valid_from), on=['begin_idx'], how='inner') \
+        .join(F.broadcast(valid_to), on=['end_idx'], how='inner') \
+        .select('model_id', 'valid_from_week', 'valid_to_week', *TREE_ATTRIBUTES)
+    return model_tree_history
+
+
+def expand_model_tree_history(model_tree_history, week, first_backtesting_cutoff):
+    """
+    Expand the model tree history on weeks, one row per (week, model)
+
+    Args:
+        model_tree_history:
+        week:
+        first_backtesting_cutoff:
+    """
+    tree_weeks = week.filter(week['wee_id_week'] >= first_backtesting_cutoff)
+    model_week_tree = model_tree_history \
+        .join(tree_weeks,
+              on=tree_weeks['wee_id_week'].cast('int').between(model_tree_history['valid_from_week'],
+                                                               model_tree_history['valid_to_week']),
               how='inner') \
-        .groupBy(week['wee_id_week'].cast('int').alias('week_id'),
-                 sku_h['mdl_num_model_r3'].alias('model_id')) \
-        .agg(F.max(sku_h['fam_num_family']).alias('family_id'),
-             F.max(sku_h['sdp_num_sub_department']).alias('sub_department_id'),
-             F.max(sku_h['dpt_num_department']).alias('department_id'),
-             F.max(sku_h['unv_num_univers']).alias('univers_id'),
-             F.max(sku_h['pnt_num_product_nature']).alias('product_nature_id'),
-             F.max(F.when(sku_h['mdl_label'].isNull(), 'UNKNOWN').otherwise(sku_h['mdl_label'])).alias('model_label'),
-             F.max(sku_h['family_label']).alias('family_label'),
-             F.max(sku_h['sdp_label']).alias('sub_department_label'),
-             F.max(sku_h['dpt_label']).alias('department_label'),
-             F.max(sku_h['unv_label']).alias('univers_label'),
-             F.max(F.when(sku_h['product_nature_label'].isNull(), 'UNDEFINED')
-                   .otherwise(sku_h['product_nature_label'])).alias('product_nature_label'),
-             F.max(sku_h['brd_label_brand']).alias('brand_label'),
-             F.max(sku_h['brd_type_brand_libelle']).alias('brand_type')) \
-        .orderBy('week_id', 'model_id')
+        .select(tree_weeks['wee_id_week'].cast('int').alias('week_id'),
+                model_tree_history['model_id'],
+                *[model_tree_history[c] for c in TREE_ATTRIBUTES])
+    return model_week_tree
+
+
+def get_model_week_tree(sku_h, week, first_backtesting_cutoff):
+    model_tree_history = get_model_tree_history(sku_h, week, first_backtesting_cutoff)
+    model_week_tree = expand_model_tree_history(model_tree_history, week, first_backtesting_cutoff)
     return model_week_tree
+
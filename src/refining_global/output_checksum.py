@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+
+import src.tools.utils as ut
+
+import pyspark.sql.functions as F
+from pyspark.sql import SparkSession
+from pyspark.sql.types import DoubleType, FloatType
+
+
+# Column used to split each refined table in partitions, default 'week_id'
+PARTITION_COLUMNS = {
+    'model_tree_history': 'valid_from_week',
+}
+
+MANIFEST_DIR = '_manifests/checksums/'
+
+
+def get_partition_column(table):
+    return PARTITION_COLUMNS.get(table, 'week_id')
+
+
+def normalize(df, float_precision):
+    """
+    Round the floating columns, so that a different summation order does not change the checksums
+
+    Args:
+        df: (SparkDataframe) refined table
+        float_precision: (int) number of decimals kept for floating columns
+
+    Returns:
+        (SparkDataframe): the normalized table, with its columns in alphabetical order
+    """
+    columns = []
+    for field in sorted(df.schema.fields, key=lambda f: f.name):
+        if isinstance(field.dataType, (DoubleType, FloatType)):
+            columns.append(F.round(F.col(field.name), float_precision).alias(field.name))
+        else:
+            columns.append(F.col(field.name))
+    return df.select(columns)
+
+
+def get_partition_checksums(df, partition_col, float_precision):
+    """
+    Compute the row count and an order independent checksum of each partition:
+    the sum of the 64 bits hash of the rows, in a decimal to avoid overflows.
+
+    Args:
+        df: (SparkDataframe) refined table
+        partition_col: (string) column splitting the table in partitions
+        float_precision: (int) number of decimals kept for floating columns
+
+    Returns:
+        object: (dict) partition value -> {'num_rows', 'checksum'}
+    """
+    df = normalize(df, float_precision)
+    partitions = df \
+        .groupBy(partition_col) \
+        .agg(F.count(F.lit(1)).alias('num_rows'),
+             F.sum(F.xxhash64(*df.columns).cast('decimal(38,0)')).alias('checksum')) \
+        .collect()
+    return {str(p[partition_col]): {'num_rows': p['num_rows'], 'checksum': str(p['checksum'])} for p in partitions}
+
+
+def write_checksum_manifest(spark, bucket, path_refined_global, run_id, tables, float_precision):
+    """
+    Compute the checksums of the tables written by this run and store them in a manifest named after the run.
+    The tables not written by this run keep the checksums of the latest manifest, so that each manifest
+    describes all the published tables.
+
+    Args:
+        spark: (SparkSession) spark app
+        bucket: (string) refined S3 bucket
+        path_refined_global: (string) prefix of the refined tables
+        run_id: (string) id of the current run
+        tables: (dict) table name -> written spark dataframe
+        float_precision: (int) number of decimals kept for floating columns
+
+    Returns:
+        object: (dict) the manifest
+    """
+    latest = ut.spark_read_text_s3(spark, bucket, path_refined_global + MANIFEST_DIR + 'latest.json')
+    manifest = json.loads(latest) if latest else {'tables': {}}
+    manifest['run_id'] = run_id
+    manifest['float_precision'] = float_precision
+    for name, df in tables.items():
+        partition_col = get_partition_column(name)
+        manifest['tables'][name] = {
+            'uri': ut.to_uri(bucket, path_refined_global + name),
+            'partition_col': partition_col,
+            'run_id': run_id,
+            'partitions': get_partition_checksums(df, partition_col, float_precision),
+        }
+        print('[{}] checksums of {} partitions computed'.format(name, len(manifest['tables'][name]['partitions'])))
+
+    content = json.dumps(manifest, indent=2, sort_keys=True)
+    ut.spark_write_text_s3(spark, bucket, path_refined_global + MANIFEST_DIR + '{}.json'.format(run_id), content)
+    ut.spark_write_text_s3(spark, bucket, path_refined_global + MANIFEST_DIR + 'latest.json', content)
+    return manifest
+
+
+def diff_manifests(manifest_a, manifest_b):
+    """
+    Compare the checksums of two manifests, table by table and partition by partition
+
+    Args:
+        manifest_a: (dict) first manifest
+        manifest_b: (dict) second manifest
+
+    Returns:
+        object: (dict) table name -> partitions only in a, only in b, and different
+    """
+    diff = {}
+    for name in sorted(set(manifest_a['tables']) | set(manifest_b['tables'])):
+        partitions_a = manifest_a['tables'].get(name, {}).get('partitions', {})
+        partitions_b = manifest_b['tables'].get(name, {}).get('partitions', {})
+        diff[name] = {
+            'only_in_a': sorted(set(partitions_a) - set(partitions_b)),
+            'only_in_b': sorted(set(partitions_b) - set(partitions_a)),
+            'different': sorted([p for p in set(partitions_a) & set(partitions_b)
+                                 if partitions_a[p] != partitions_b[p]]),
+        }
+    return diff
+
+
+def get_row_differences(spark, table_a, table_b, partitions, float_precision):
+    """
+    Get the rows which differ between two versions of a table, reading only the given partitions
+
+    Args:
+        spark: (SparkSession) spark app
+        table_a: (dict) table entry of the first manifest
+        table_b: (dict) table entry of the second manifest
+        partitions: (list) partition values to compare
+        float_precision: (int) number of decimals kept for floating columns
+
+    Returns:
+        (SparkDataframe): rows only in a or only in b, with a column 'side'
+    """
+    partition_col = table_a['partition_col']
+    df_a = spark.read.parquet(table_a['uri'])
+    df_b = spark.read.parquet(table_b['uri'])
+    # The partition values are week ids: filtered on the typed column, so that the filter is pushed down to parquet
+    partitions = [int(p) for p in partitions]
+    df_a = normalize(df_a.filter(df_a[partition_col].isin(partitions)), float_precision)
+    df_b = normalize(df_b.filter(df_b[partition_col].isin(partitions)), float_precision)
+    return df_a.exceptAll(df_b).withColumn('side', F.lit('a')) \
+        .union(df_b.exceptAll(df_a).withColumn('side', F.lit('b')))
+
+
+def read_manifest(spark, uri):
+    return json.loads(spark.read.text(uri, wholetext=True).collect()[0][0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two checksum manifests of the refined tables')
+    parser.add_argument('manifest_a', help="URI of the first manifest")
+    parser.add_argument('manifest_b', help="URI of the second manifest")
+    parser.add_argument('--rows', type=int, default=0,
+                        help="Number of differing rows to show per table (the partitions are read only if > 0)")
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.getOrCreate()
+    spark.sparkContext.setLogLevel('ERROR')
+    manifest_a = read_manifest(spark, args.manifest_a)
+    manifest_b = read_manifest(spark, args.manifest_b)
+
+    nb_differences = 0
+    for name, table_diff in diff_manifests(manifest_a, manifest_b).items():
+        print('[{}] only in a: {} | only in b: {} | different: {}'.format(
+            name, table_diff['only_in_a'], table_diff['only_in_b'], table_diff['different']))
+        nb_differences += sum([len(partitions) for partitions in table_diff.values()])
+        if args.rows > 0 and table_diff['different']:
+            get_row_differences(spark, manifest_a['tables'][name], manifest_b['tables'][name],
+                                table_diff['different'], manifest_a.get('float_precision', 6)) \
+                .orderBy(get_partition_column(name), 'side') \
+                .show(args.rows, truncate=False)
+
+    print('Partitions differing: {}'.format(nb_differences))
+    spark.stop()
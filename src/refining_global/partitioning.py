@@ -0,0 +1,62 @@
+import src.tools.utils as ut
+
+from pyspark import StorageLevel
+
+
+def write_bucketed(spark, df, name, key, num_buckets, database, bucket, path):
+    """
+    Write an intermediate table bucketed on its join key and reload it from the metastore,
+    so that joins on the key reuse its partitioning instead of shuffling it again.
+
+    Args:
+        spark: (SparkSession) spark app
+        df: (SparkDataframe) the intermediate table
+        name: (string) name of the intermediate table
+        key: (string) join key
+        num_buckets: (int) number of buckets, equal to the shuffle partitions
+        database: (string) metastore database of the intermediate tables
+        bucket: (string) S3 bucket
+        path: (string) full path to the intermediate directory within the S3 bucket
+
+    Returns:
+        (SparkDataframe): the bucketed table
+    """
+    table_name = '{}.refining_{}'.format(database, name)
+    df.write \
+        .bucketBy(num_buckets, key) \
+        .sortBy(key) \
+        .option('path', ut.to_uri(bucket, path + name)) \
+        .saveAsTable(table_name, format='parquet', mode='overwrite')
+    return spark.table(table_name)
+
+
+def co_partition(spark, df, name, key, partitioning_params, num_partitions, bucket, path):
+    """
+    Materialize an intermediate table hash partitioned on its join key:
+        - 'bucketed': written as a bucketed table in the metastore
+        - 'cache': repartitioned on the key then cached
+        - 'none': cached as is (the join shuffles it)
+    Aggregates on the key are hash partitioned in spark.sql.shuffle.partitions, so num_partitions
+    must be equal to it for the joins to skip the exchange on both sides.
+
+    Args:
+        spark: (SparkSession) spark app
+        df: (SparkDataframe) the intermediate table
+        name: (string) name of the intermediate table
+        key: (string) join key
+        partitioning_params: (dict) partitioning parameters
+        num_partitions: (int) number of partitions
+        bucket: (string) S3 bucket of the bucketed tables
+        path: (string) full path to the intermediate directory within the S3 bucket
+
+    Returns:
+        (SparkDataframe): the partitioned table
+    """
+    mode = partitioning_params['mode']
+    if mode == 'bucketed':
+        return write_bucketed(spark, df, name, key, num_partitions, partitioning_params['database'], bucket, path)
+    elif mode == 'cache':
+        return df.repartition(num_partitions, key).persist(StorageLevel.MEMORY_AND_DISK)
+    elif mode == 'none':
+        return df.persist(StorageLevel.MEMORY_ONLY)
+    raise ValueError("Unknown partitioning mode '{}'".format(mode))
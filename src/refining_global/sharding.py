@@ -0,0 +1,210 @@
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import src.tools.utils as ut
+
+import fact_sources as fs
+import model_week_sales as sales
+import model_week_mrp as mrp
+
+import pyspark.sql.functions as F
+from pyspark import StorageLevel
+
+
+# Written last in the directory of a shard: the week & the purchase organizations of its outputs
+MARKER = '_shard.json'
+
+
+def get_spark_conf(sharding_params):
+    """
+    Get the Spark configurations needed to run the shards in parallel within the Spark app
+
+    Args:
+        sharding_params: (dict) sharding parameters
+
+    Returns:
+        object: (list) a list of tuples <spark_configuration_name, value>
+    """
+    if not sharding_params['enabled']:
+        return []
+    return [('spark.scheduler.mode', 'FAIR')]
+
+
+def get_shards(list_purch_org, sharding_params):
+    """
+    Get the shards to process: one per purchase organization, unless groups are configured.
+    The groups must be a partition of the purchase organizations of the run: a purchase organization in no group
+    would be missing from the merged outputs, one in two groups would be counted twice by the merge.
+
+    Args:
+        list_purch_org: (list) purchase organizations of the run
+        sharding_params: (dict) sharding parameters
+
+    Returns:
+        object: (OrderedDict) shard name -> purchase organizations of the shard
+    """
+    groups = sharding_params['shards'] or [[purch_org] for purch_org in list_purch_org]
+    grouped = [purch_org for group in groups for purch_org in group]
+    missing = sorted(set(list_purch_org) - set(grouped))
+    unknown = sorted(set(grouped) - set(list_purch_org))
+    duplicated = sorted(set([purch_org for purch_org in grouped if grouped.count(purch_org) > 1]))
+    if missing or unknown or duplicated:
+        raise Exception('The shards {} must be a partition of the purchase organizations {}: missing {}, '
+                        'unknown {}, in several shards {}'.format(groups, list_purch_org, missing, unknown,
+                                                                  duplicated))
+    return OrderedDict(('_'.join(group), group) for group in groups)
+
+
+def select_shards(shards, shard_names=None):
+    """
+    Select the shards to run, e.g. to rerun a failed shard alone
+
+    Args:
+        shards: (OrderedDict) output of get_shards
+        shard_names: (string) comma separated shard names, None for all the shards
+
+    Returns:
+        object: (OrderedDict) shard name -> purchase organizations of the shard
+    """
+    if not shard_names:
+        return shards
+    names = [name.strip() for name in shard_names.split(',') if name.strip()]
+    unknown = [name for name in names if name not in shards]
+    if unknown:
+        raise Exception('Unknown shards {}, expected some of {}'.format(unknown, list(shards.keys())))
+    return OrderedDict((name, shards[name]) for name in names)
+
+
+def compute_shard(spark, name, purch_orgs, tables, params, current_week, bucket, path_shards, nb_partitions, run_id):
+    """
+    Compute & write the sales cube and the APO MRP of a shard.
+    Both are mergeable: partial sums for the sales, max of the active flag for the MRP.
+    A marker written last records the week & the purchase organizations the outputs were computed for.
+
+    Args:
+        spark: (SparkSession) spark app
+        name: (string) name of the shard
+        purch_orgs: (list) purchase organizations of the shard
+        tables: (dict) table name -> filtered clean table
+        params: (Configuration) parameters of the run
+        current_week: (int) current week id
+        bucket: (string) refined S3 bucket
+        path_shards: (string) full path to the shards directory within the S3 bucket
+        nb_partitions: (int) number of files written per shard output
+        run_id: (string) id of the current run
+    """
+    # An interrupted attempt must not leave the marker of a previous computation
+    fs_shard, marker_path = ut.get_hadoop_path(spark, bucket, path_shards + name + '/' + MARKER)
+    if fs_shard.exists(marker_path):
+        fs_shard.delete(marker_path, False)
+    sapb = tables['sapb'].filter(tables['sapb']['purch_org'].isin(purch_orgs))
+
+    shard_tables = dict(tables, sapb=sapb)
+    sales_lines = fs.get_sales_lines(fs.get_fact_lines(shard_tables), shard_tables, params.taiwan_list)
+    sales_cube = sales.get_sales_cube(sales_lines)
+    ut.spark_write_parquet_s3(sales_cube.filter(F.col('week_id') < current_week), bucket,
+                              path_shards + name + '/sales_cube', nb_partitions)
+    sales_cube.unpersist()
+
+    model_week_mrp_apo = mrp.get_model_week_mrp_apo(tables['gdw'], sapb, tables['sku'], tables['day'],
+                                                    params.white_list)
+    ut.spark_write_parquet_s3(model_week_mrp_apo, bucket, path_shards + name + '/model_week_mrp_apo', nb_partitions)
+
+    marker = {'current_week': current_week, 'purch_org': sorted(purch_orgs), 'run_id': run_id}
+    ut.spark_write_text_s3(spark, bucket, path_shards + name + '/' + MARKER,
+                           json.dumps(marker, indent=2))
+
+
+def run_shards(spark, shards, tables, params, current_week, bucket, path_shards, run_id):
+    """
+    Run the shards in parallel within the Spark app (each one in its own fair scheduler pool),
+    retrying each failed shard alone. A shard still failing after its retries fails the run,
+    once the other shards are done: it can then be rerun alone with --shards.
+
+    Args:
+        spark: (SparkSession) spark app
+        shards: (dict) shard name -> purchase organizations of the shard
+        tables: (dict) table name -> filtered clean table
+        params: (Configuration) parameters of the run
+        current_week: (int) current week id
+        bucket: (string) refined S3 bucket
+        path_shards: (string) full path to the shards directory within the S3 bucket
+        run_id: (string) id of the current run
+
+    Returns:
+        object: (list) report of each shard
+    """
+    sharding_params = params.sharding
+
+    def run(name):
+        spark.sparkContext.setLocalProperty('spark.scheduler.pool', name)
+        spark.sparkContext.setJobGroup(name, 'shard {}'.format(name))
+        for attempt in range(1, sharding_params['max_retries'] + 2):
+            start = time.time()
+            try:
+                compute_shard(spark, name, shards[name], tables, params, current_week, bucket, path_shards,
+                              sharding_params['output_partitions'], run_id)
+                print('[shard {}] done in {} second(s)'.format(name, int(time.time() - start)))
+                return {'shard': name, 'purch_org': shards[name], 'attempts': attempt,
+                        'seconds': int(time.time() - start)}
+            except Exception as e:
+                print('[shard {}] attempt {} failed: {}'.format(name, attempt, e))
+                if attempt > sharding_params['max_retries']:
+                    raise
+
+    with ThreadPoolExecutor(max_workers=sharding_params['parallelism']) as executor:
+        return list(executor.map(run, list(shards.keys())))
+
+
+def check_shard_markers(spark, shards, current_week, bucket, path_shards):
+    """
+    Check that the outputs of all shards were computed for the current week & their purchase organizations,
+    e.g. that the shards not rerun by --shards after a week change are not merged with the rerun ones
+
+    Args:
+        spark: (SparkSession) spark app
+        shards: (OrderedDict) shard name -> purchase organizations of the shard
+        current_week: (int) current week id
+        bucket: (string) refined S3 bucket
+        path_shards: (string) full path to the shards directory within the S3 bucket
+    """
+    stale = []
+    for name, purch_orgs in shards.items():
+        content = ut.spark_read_text_s3(spark, bucket, path_shards + name + '/' + MARKER)
+        marker = json.loads(content) if content else {}
+        if marker.get('current_week') != current_week or marker.get('purch_org') != sorted(purch_orgs):
+            stale.append('{} ({})'.format(name, marker or 'no marker'))
+    if stale:
+        raise Exception('Shards not computed for the week {}, to rerun with --shards: {}'
+                        .format(current_week, ', '.join(stale)))
+
+
+def merge_shards(spark, shards, current_week, bucket, path_shards):
+    """
+    Merge the outputs of all shards into the global sales cube & APO MRP, once checked that they were all
+    computed for the current week
+
+    Args:
+        spark: (SparkSession) spark app
+        shards: (OrderedDict) all shards of the run, shard name -> purchase organizations of the shard
+        current_week: (int) current week id
+        bucket: (string) refined S3 bucket
+        path_shards: (string) full path to the shards directory within the S3 bucket
+
+    Returns:
+        object: (tuple) sales cube, model week MRP from APO
+    """
+    check_shard_markers(spark, shards, current_week, bucket, path_shards)
+    shard_names = list(shards.keys())
+    sales_cube = ut.union_all(
+        [ut.spark_read_parquet_s3(spark, bucket, path_shards + name + '/sales_cube') for name in shard_names])
+    sales_cube = sales.merge_sales_partials(sales_cube, sales.CUBE_KEYS).persist(StorageLevel.MEMORY_AND_DISK)
+
+    model_week_mrp_apo = ut.union_all(
+        [ut.spark_read_parquet_s3(spark, bucket, path_shards + name + '/model_week_mrp_apo') for name in shard_names])
+    model_week_mrp_apo = model_week_mrp_apo \
+        .groupBy('week_id', 'model_id') \
+        .agg(F.max('is_mrp_active').alias('is_mrp_active'))
+    return sales_cube, model_week_mrp_apo
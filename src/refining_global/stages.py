@@ -0,0 +1,112 @@
+from collections import OrderedDict
+
+
+# Stage name -> clean tables read, upstream stages & published outputs, filled by the @stage declarations
+# of the refining functions. They drive the selection of the stages, of the tables read & of the fingerprints;
+# the stages are run by the main, which computes them differently by mode (shards, time slices, backtesting).
+STAGES = OrderedDict()
+
+
+def stage(name, inputs, upstream, outputs):
+    """
+    Declare the refining function computing a stage of the refining
+
+    Args:
+        name: (string) name of the stage
+        inputs: (list) clean tables read by the stage
+        upstream: (list) stages whose outputs are read by the stage (published ones if not run)
+        outputs: (list) refined tables published by the stage
+    """
+    def register(function):
+        STAGES[name] = {'inputs': inputs, 'upstream': upstream, 'outputs': outputs}
+        return function
+    return register
+
+
+def get_ordered_stages():
+    """
+    Get the stages in an order where each stage comes after its upstream stages
+
+    Returns:
+        object: (list) stage names
+    """
+    ordered = []
+    while len(ordered) < len(STAGES):
+        ready = [name for name, s in STAGES.items()
+                 if name not in ordered and all([u in ordered for u in s['upstream']])]
+        if not ready:
+            raise Exception('Cycle between the stages {}'.format(sorted(set(STAGES) - set(ordered))))
+        ordered += ready
+    return ordered
+
+
+def get_downstream_stages(names):
+    """
+    Get the given stages and all the stages depending on them, directly or not
+
+    Args:
+        names: (list) stage names
+
+    Returns:
+        object: (list) stage names, in execution order
+    """
+    selected = set(names)
+    for name in get_ordered_stages():
+        if set(STAGES[name]['upstream']) & selected:
+            selected.add(name)
+    return [name for name in get_ordered_stages() if name in selected]
+
+
+def select_stages(only=None, from_stages=None):
+    """
+    Select the stages to run:
+        - only: exactly these stages, their upstream stages are read from the published outputs
+        - from_stages: these stages and all their downstream stages
+        - neither: all the stages
+
+    Args:
+        only: (string) comma separated stage names
+        from_stages: (string) comma separated stage names
+
+    Returns:
+        object: (list) stage names, in execution order
+    """
+    if only and from_stages:
+        raise Exception('--only and --from cannot be used together')
+    targets = (only or from_stages or '').split(',')
+    targets = [t.strip() for t in targets if t.strip()]
+    unknown = set(targets) - set(STAGES)
+    if unknown:
+        raise Exception('Unknown stages {}, expected some of {}'.format(sorted(unknown), list(STAGES)))
+    if only:
+        return [name for name in get_ordered_stages() if name in targets]
+    if from_stages:
+        return get_downstream_stages(targets)
+    return get_ordered_stages()
+
+
+def get_input_tables(names):
+    """
+    Get the clean tables read by some stages
+
+    Args:
+        names: (list) stage names
+
+    Returns:
+        object: (list) clean table names
+    """
+    return sorted(set([table for name in names for table in STAGES[name]['inputs']]))
+
+
+def get_reused_stages(names):
+    """
+    Get the upstream stages not run, whose published outputs are read
+
+    Args:
+        names: (list) stage names run
+
+    Returns:
+        object: (list) stage names
+    """
+    return [name for name in get_ordered_stages()
+            if name not in names and any([name in STAGES[n]['upstream'] for n in names])]
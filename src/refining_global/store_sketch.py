@@ -0,0 +1,104 @@
+import pyspark.sql.functions as F
+
+
+# HyperLogLog sketches built with native Spark functions (Spark 3.1 has no sketch aggregate): each store is hashed
+# with xxhash64, the low bits select a register and the register keeps the max rank of the first 1 bit in the others.
+# A sketch is stored sparse, as the array of its non empty registers: a model week is sold by a few stores only.
+# Sketches are merged by a max per register, so the distinct stores of several weeks or channels are counted
+# without reading the sales again.
+
+
+def get_registers(store_col, precision):
+    """
+    Get the register & the rank of each store
+
+    Args:
+        store_col: (Column) store id
+        precision: (int) number of bits of the register index, 2 ** precision registers
+
+    Returns:
+        object: (tuple) register index, rank columns
+    """
+    hashed = F.xxhash64(store_col)
+    idx = hashed.bitwiseAND((1 << precision) - 1).cast('int')
+    remaining = F.shiftRightUnsigned(hashed, precision)
+    # rank of the first 1 bit in the (64 - precision) remaining bits, from the left
+    rho = F.when(remaining == 0, 64 - precision + 1) \
+        .otherwise(F.lit(64 - precision + 1) - F.length(F.bin(remaining))).cast('int')
+    return idx.alias('idx'), rho.alias('rho')
+
+
+def get_store_sketches(store_sales, keys, precision):
+    """
+    Build the store sketch of each keys from store level sales
+
+    Args:
+        store_sales: (SparkDataframe) sales with a but_idr_business_unit column
+        keys: (list) keys of the sketches, e.g. ['model_id', 'week_id', 'channel']
+        precision: (int) number of bits of the register index
+
+    Returns:
+        (SparkDataframe): keys & registers
+    """
+    sketches = store_sales \
+        .select(*keys, *get_registers(F.col('but_idr_business_unit'), precision)) \
+        .groupBy(*keys, 'idx') \
+        .agg(F.max('rho').alias('rho')) \
+        .groupBy(*keys) \
+        .agg(F.collect_list(F.struct('idx', 'rho')).alias('registers'))
+    return sketches
+
+
+def get_merged_registers(sketches, keys):
+    """
+    Merge the sketches on coarser keys (e.g. several weeks or channels), one row per keys & non empty register
+    """
+    return sketches \
+        .select(*keys, F.explode('registers').alias('register')) \
+        .groupBy(*keys, F.col('register.idx').alias('idx')) \
+        .agg(F.max('register.rho').alias('rho'))
+
+
+def merge_sketches(sketches, keys):
+    """
+    Merge the sketches on coarser keys, into sketches
+
+    Args:
+        sketches: (SparkDataframe) keys & registers
+        keys: (list) keys of the merged sketches
+
+    Returns:
+        (SparkDataframe): keys & registers
+    """
+    return get_merged_registers(sketches, keys) \
+        .groupBy(*keys) \
+        .agg(F.collect_list(F.struct('idx', 'rho')).alias('registers'))
+
+
+def estimate_distinct(sketches, keys, precision, alias):
+    """
+    Estimate the number of distinct stores of the merged sketches, with the linear counting correction
+    when many registers are empty (always the case for the store counts of a model, almost exact then)
+
+    Args:
+        sketches: (SparkDataframe) keys & registers
+        keys: (list) keys of the merged sketches
+        precision: (int) number of bits of the register index of the sketches
+        alias: (string) name of the estimate column
+
+    Returns:
+        (SparkDataframe): keys & estimate
+    """
+    m = float(1 << precision)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimates = get_merged_registers(sketches, keys) \
+        .groupBy(*keys) \
+        .agg(F.sum(F.pow(F.lit(2.0), -F.col('rho'))).alias('sum_non_empty'),
+             F.count('idx').alias('non_empty')) \
+        .withColumn('empty', F.lit(m) - F.col('non_empty')) \
+        .withColumn('raw', F.lit(alpha * m * m) / (F.col('sum_non_empty') + F.col('empty'))) \
+        .withColumn(alias, F.round(F.when((F.col('raw') <= 2.5 * m) & (F.col('empty') > 0),
+                                          F.lit(m) * F.log(F.lit(m) / F.col('empty')))
+                                   .otherwise(F.col('raw'))).cast('long')) \
+        .select(*keys, alias)
+    return estimates
@@ -0,0 +1,101 @@
+import time
+from datetime import timedelta
+
+import src.tools.utils as ut
+import src.tools.spark_metrics as metrics
+
+import fact_sources as fs
+import model_week_sales as sales
+
+import pyspark.sql.functions as F
+
+
+def get_week_slices(week, weeks_per_slice):
+    """
+    Split the filtered weeks in consecutive slices
+
+    Args:
+        week: (SparkDataframe) filtered weeks
+        weeks_per_slice: (int) number of weeks per slice, e.g. 13 for quarters
+
+    Returns:
+        object: (list) week ids of each slice
+    """
+    week_ids = sorted([int(w[0]) for w in week.select('wee_id_week').distinct().collect()])
+    return [week_ids[i:i + weeks_per_slice] for i in range(0, len(week_ids), weeks_per_slice)]
+
+
+def get_slice_sales_cube(tables, slice_weeks, taiwan_list):
+    """
+    Compute the sales cube of the days of a slice. The facts are filtered on the days of the slice before any join,
+    so that only the lines of the slice are shuffled.
+
+    Args:
+        tables: (dict) table name -> filtered clean table
+        slice_weeks: (list) week ids of the slice
+        taiwan_list: (list) models sold in Taiwan by another way
+
+    Returns:
+        (SparkDataframe): the sales cube of the slice
+    """
+    first_week, last_week = slice_weeks[0], slice_weeks[-1]
+    day = tables['day'].filter(tables['day']['wee_id_week'].between(first_week, last_week))
+    week = tables['week'].filter(tables['week']['wee_id_week'].between(first_week, last_week))
+    first_day, last_day = day.agg(F.min('day_id_day'), F.max('day_id_day')).collect()[0]
+    # The raw column is compared to literal bounds, so that the filter is pushed down to the parquet scans
+    # (a 'yyyy-MM-dd...' string or a timestamp, both ordered like the ISO days)
+    fact_lines = fs.get_fact_lines(tables)
+    fact_lines = fact_lines.filter((fact_lines['tdt_date_to_ordered'] >= first_day.isoformat()) &
+                                   (fact_lines['tdt_date_to_ordered'] < (last_day + timedelta(days=1)).isoformat()))
+
+    slice_tables = dict(tables, day=day, week=week)
+    return sales.get_sales_cube(fs.get_sales_lines(fact_lines, slice_tables, taiwan_list))
+
+
+def run_slices(spark, tables, params, current_week, shuffle_partitions, bucket, path_slices):
+    """
+    Compute the sales cube slice after slice and append each slice to the sliced cube, so that the peak memory
+    and the shuffles are bounded by the biggest slice instead of the whole history. The cube is keyed by day:
+    the slices do not overlap and their union is exactly the cube of the whole history.
+    The shuffle partitions are scaled down to the size of a slice.
+
+    Args:
+        spark: (SparkSession) spark app
+        tables: (dict) table name -> filtered clean table
+        params: (Configuration) parameters of the run
+        current_week: (int) current week id
+        shuffle_partitions: (int) shuffle partitions of the whole history
+        bucket: (string) refined S3 bucket
+        path_slices: (string) full path to the sliced cube within the S3 bucket
+
+    Returns:
+        object: (list) report of each slice, with its volumes, spills & peak memory
+    """
+    slicing_params = params.time_slicing
+    week_slices = [s for s in get_week_slices(tables['week'], slicing_params['weeks_per_slice'])
+                   if s[0] < current_week]
+    nb_weeks = sum([len(s) for s in week_slices])
+    slice_reports = []
+    for i, slice_weeks in enumerate(week_slices):
+        job_group = 'slice_{}_{}'.format(slice_weeks[0], slice_weeks[-1])
+        slice_partitions = max(params.profiler['min_shuffle_partitions'],
+                               int(shuffle_partitions * len(slice_weeks) / nb_weeks))
+        spark.conf.set('spark.sql.shuffle.partitions', slice_partitions)
+        spark.sparkContext.setJobGroup(job_group, 'sales of weeks {} to {}'.format(slice_weeks[0], slice_weeks[-1]))
+        start = time.time()
+
+        slice_cube = get_slice_sales_cube(tables, slice_weeks, params.taiwan_list)
+        ut.spark_write_parquet_s3(slice_cube.filter(F.col('week_id') < current_week), bucket, path_slices,
+                                  slicing_params['output_partitions'], mode='overwrite' if i == 0 else 'append')
+        slice_cube.unpersist()
+
+        slice_report = {'slice': job_group, 'shuffle_partitions': slice_partitions,
+                        'seconds': int(time.time() - start)}
+        slice_report.update(metrics.get_job_group_metrics(spark, job_group))
+        print('[{}] {}'.format(job_group, slice_report))
+        slice_reports.append(slice_report)
+
+    spark.sparkContext.setLocalProperty('spark.jobGroup.id', None)
+    spark.sparkContext.setLocalProperty('spark.job.description', None)
+    spark.conf.set('spark.sql.shuffle.partitions', shuffle_partitions)
+    return slice_reports
@@ -49,6 +49,17 @@ class Configuration(object):
         self.taiwan_list = self.get_taiwan_self_sale_list_id()
         self.but_path = self.get_business_path()
         self.but_week = self.get_business_week()
+        self.write_model_week_tree = self.get_write_model_week_tree()
+        self.profiler = self.get_profiler_params()
+        self.fingerprint = self.get_fingerprint_params()
+        self.partitioning = self.get_partitioning_params()
+        self.checksum = self.get_checksum_params()
+        self.storage = self.get_storage_params()
+        self.sharding = self.get_sharding_params()
+        self.matrix_export = self.get_matrix_export_params()
+        self.anomaly_detection = self.get_anomaly_detection_params()
+        self.time_slicing = self.get_time_slicing_params()
+        self.store_count = self.get_store_count_params()
 
 
     def pretty_print_dict(self):
@@ -108,6 +119,125 @@ class Configuration(object):
         """
         return list(self._yaml_dict['technical_parameters']['spark_conf'].items())
 
+    def get_profiler_params(self):
+        """
+        Get the input profiler parameters, completed with default values
+
+        Returns:
+            object: (dict) the profiler parameters
+        """
+        profiler = {
+            'enabled': False,
+            'target_partition_mb': 128,
+            'broadcast_threshold_mb': 256,
+            'size_expansion_factor': 3,
+            'min_shuffle_partitions': 200,
+            'max_shuffle_partitions': 4000,
+        }
+        profiler.update(self._yaml_dict['technical_parameters'].get('profiler') or {})
+        return profiler
+
+    def get_fingerprint_params(self):
+        """
+        Get the input fingerprint parameters, completed with default values
+
+        Returns:
+            object: (dict) the input fingerprint parameters
+        """
+        fingerprint = {'enabled': False}
+        fingerprint.update(self._yaml_dict['technical_parameters'].get('fingerprint') or {})
+        return fingerprint
+
+    def get_partitioning_params(self):
+        """
+        Get the partitioning parameters of the intermediate tables, completed with default values
+
+        Returns:
+            object: (dict) the partitioning parameters
+        """
+        partitioning = {'mode': 'none', 'database': 'default'}
+        partitioning.update(self._yaml_dict['technical_parameters'].get('partitioning') or {})
+        return partitioning
+
+    def get_checksum_params(self):
+        """
+        Get the output checksum parameters, completed with default values
+
+        Returns:
+            object: (dict) the output checksum parameters
+        """
+        checksum = {'enabled': False, 'float_precision': 6}
+        checksum.update(self._yaml_dict['technical_parameters'].get('checksum') or {})
+        return checksum
+
+    def get_storage_params(self):
+        """
+        Get the storage backend parameters (default: EMRFS 's3://')
+
+        Returns:
+            object: (dict) the storage parameters
+        """
+        return self._yaml_dict['technical_parameters'].get('storage') or {}
+
+    def get_sharding_params(self):
+        """
+        Get the purchase organization sharding parameters, completed with default values
+
+        Returns:
+            object: (dict) the sharding parameters
+        """
+        sharding = {'enabled': False, 'shards': None, 'parallelism': 2, 'max_retries': 1, 'output_partitions': 50}
+        sharding.update(self._yaml_dict['technical_parameters'].get('sharding') or {})
+        return sharding
+
+    def get_matrix_export_params(self):
+        """
+        Get the model x week matrix export parameters, completed with default values
+
+        Returns:
+            object: (dict) the matrix export parameters
+        """
+        matrix_export = {'enabled': False, 'models_per_shard': 20000}
+        matrix_export.update(self._yaml_dict['technical_parameters'].get('matrix_export') or {})
+        return matrix_export
+
+    def get_anomaly_detection_params(self):
+        """
+        Get the sales anomaly detection parameters, completed with default values
+
+        Returns:
+            object: (dict) the anomaly detection parameters
+        """
+        anomaly_detection = {'enabled': False, 'lookback_weeks': 8, 'check_weeks': 2, 'min_active_weeks': 6,
+                             'min_rolling_mean': 5, 'zscore_threshold': 5, 'max_spike_ratio': 0.05,
+                             'max_drop_ratio': 0.1, 'expected_channels': ['offline', 'online']}
+        anomaly_detection.update(self._yaml_dict['technical_parameters'].get('anomaly_detection') or {})
+        return anomaly_detection
+
+    def get_time_slicing_params(self):
+        """
+        Get the time slicing parameters of the sales, completed with default values
+
+        Returns:
+            object: (dict) the time slicing parameters
+        """
+        time_slicing = {'enabled': False, 'weeks_per_slice': 13, 'output_partitions': 20}
+        time_slicing.update(self._yaml_dict['technical_parameters'].get('time_slicing') or {})
+        return time_slicing
+
+    def get_store_count_params(self):
+        """
+        Get the parameters of the store counts of the BI dynamic features, completed with default values
+
+        Returns:
+            object: (dict) the store count parameters
+        """
+        store_count = {'mode': 'exact', 'precision': 12, 'rolling_weeks': [4, 13], 'rebuild_weeks': 4}
+        store_count.update(self._yaml_dict['technical_parameters'].get('store_count') or {})
+        if store_count['mode'] not in ('exact', 'sketch'):
+            raise Exception("Unknown store count mode '{}', expected 'exact' or 'sketch'".format(store_count['mode']))
+        return store_count
+
     def get_first_historical_week(self):
         """
         Get first Historical week param (Functional Param).
@@ -126,6 +256,15 @@ class Configuration(object):
         """
         return self._yaml_dict['functional_parameters']['first_backtesting_cutoff']
 
+    def get_write_model_week_tree(self):
+        """
+        Get if the model tree history has to be expanded & written week by week as model_week_tree (Functional Param)
+
+        Returns:
+            object: (bool) True to write model_week_tree, default True
+        """
+        return self._yaml_dict['functional_parameters'].get('write_model_week_tree', True)
+
     def get_list_purch_org(self):
         """
         Get list of countries where model is applied
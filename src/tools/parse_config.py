@@ -29,6 +29,18 @@ def basic_parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--configfile', required=True,
                         help="Technical configuration file (YAML format)")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Recompute all outputs, even if their inputs did not change since the last run")
+    parser.add_argument('-s', '--shards', default=None,
+                        help="Sharded mode: comma separated names of the shards to (re)compute, default all shards")
+    parser.add_argument('-b', '--backtest-cutoffs', default=None,
+                        help="Backtesting mode: comma separated cutoff week ids, the refined tables of each cutoff "
+                             "are written under backtesting/ instead of the current tables")
+    parser.add_argument('--only', default=None,
+                        help="Comma separated stages to run (e.g. model_week_mrp), the outputs of their upstream "
+                             "stages are read from the published tables")
+    parser.add_argument('--from', dest='from_stages', default=None,
+                        help="Comma separated stages to run with all their downstream stages")
     return parser.parse_args()
 
 
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+
+import pyspark.sql.functions as F
+from pyspark import StorageLevel
+
+import src.tools.utils as ut
+
+
+SALES_KEYS = ['model_id', 'week_id', 'date', 'channel']
+
+# Measure of each sales table
+SALES_MEASURES = OrderedDict([
+    ('model_week_sales', 'sales_quantity'),
+    ('model_week_price', 'average_price'),
+    ('model_week_turnover', 'sum_turnover'),
+])
+
+
+class RefinedReader(object):
+    """
+    Class used to read the refined tables filtered on models, weeks & channel. The filters are pushed down to
+    the parquet scan: the refined files hold disjoint model ranges and are sorted on model_id & the week, so that
+    the files & row groups not matching the model filter are skipped, and the backtesting tables are partitioned
+    by cutoff. The tables restricted to some models & a week range are kept in a LRU cache, so that the next
+    requests on the same selection (e.g. with other measures, the tree or the MRP) do not scan the files again.
+
+    Example:
+        reader = RefinedReader(spark, 'fcst-refined-demand-forecast-prod', 'global/')
+        reader.sales(models=[8529384], weeks=(202101, 202152), channel='offline', with_tree=True).show()
+    """
+
+    def __init__(self, spark, bucket, path_refined_global, cutoff=None, cache_size=8):
+        """
+        Args:
+            spark: (SparkSession) spark app
+            bucket: (string) refined S3 bucket
+            path_refined_global: (string) prefix of the refined tables
+            cutoff: (int) cutoff week id to read the backtesting tables of, None for the current tables
+            cache_size: (int) maximum number of selections kept in the cache, 0 to disable the cache
+        """
+        self.spark = spark
+        self.bucket = bucket
+        self.path_refined_global = path_refined_global
+        self.cutoff = cutoff
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _get_path(self, table):
+        if self.cutoff is None:
+            return self.path_refined_global + table
+        return self.path_refined_global + 'backtesting/' + table
+
+    def _load(self, table, models, weeks):
+        """
+        Load a table restricted to some models & a week range, from the cache if it was recently loaded.
+        The filters are applied before caching, so that they are pushed down to the parquet scan.
+
+        Args:
+            table: (string) name of the refined table
+            models: (list) model ids, None for all models
+            weeks: (tuple) first & last week ids (included), None for all weeks
+
+        Returns:
+            (SparkDataframe): the table restricted to the models & the week range
+        """
+        models = None if models is None else tuple(sorted(set([int(m) for m in models])))
+        key = (table, models, weeks)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        df = ut.spark_read_parquet_s3(self.spark, self.bucket, self._get_path(table))
+        if self.cutoff is not None:
+            df = df.filter(F.col('cutoff') == self.cutoff).drop('cutoff')
+        if models is not None:
+            df = df.filter(F.col('model_id').isin(list(models)))
+        if weeks is not None:
+            if table == 'model_tree_history':
+                df = df.filter((F.col('valid_to_week') >= weeks[0]) & (F.col('valid_from_week') <= weeks[1]))
+            else:
+                df = df.filter(F.col('week_id').between(weeks[0], weeks[1]))
+
+        # Only the restricted selections are cached, a full table is read again at each request
+        if (models is not None or weeks is not None) and self.cache_size > 0:
+            self._cache[key] = df.persist(StorageLevel.MEMORY_AND_DISK)
+            while len(self._cache) > self.cache_size:
+                _, evicted = self._cache.popitem(last=False)
+                evicted.unpersist()
+        return df
+
+    def clear_cache(self):
+        for df in self._cache.values():
+            df.unpersist()
+        self._cache.clear()
+
+    @staticmethod
+    def _get_weeks(weeks):
+        if weeks is None or isinstance(weeks, tuple):
+            return weeks
+        return int(weeks), int(weeks)
+
+    def tree(self, models=None, weeks=None):
+        """
+        Get the model tree history (one row per model & change interval)
+
+        Args:
+            models: (list) model ids, None for all models
+            weeks: (int or tuple) week id, or first & last week ids (included), None for all weeks
+
+        Returns:
+            (SparkDataframe): the intervals overlapping the weeks
+        """
+        return self._load('model_tree_history', models, self._get_weeks(weeks))
+
+    def mrp(self, models=None, weeks=None):
+        """
+        Get the model week MRP
+
+        Args:
+            models: (list) model ids, None for all models
+            weeks: (int or tuple) week id, or first & last week ids (included), None for all weeks
+
+        Returns:
+            (SparkDataframe): week_id, model_id, is_mrp_active
+        """
+        return self._load('model_week_mrp', models, self._get_weeks(weeks))
+
+    def sales(self, models=None, weeks=None, channel=None, measures=('sales_quantity',), with_tree=False,
+              with_mrp=False):
+        """
+        Get the sales measures, joined on their keys, and optionally the tree & MRP of their model week.
+        The tables are only read when requested.
+
+        Args:
+            models: (list) model ids, None for all models
+            weeks: (int or tuple) week id, or first & last week ids (included), None for all weeks
+            channel: (string) 'offline' or 'online', None for all channels
+            measures: (tuple) measures among 'sales_quantity', 'average_price', 'sum_turnover'
+            with_tree: (bool) add the tree attributes of the model at the week, the weeks before the tree are dropped
+            with_mrp: (bool) add the MRP status of the model at the week, null if unknown
+
+        Returns:
+            (SparkDataframe): model_id, week_id, date, channel & the measures
+        """
+        weeks = self._get_weeks(weeks)
+        unknown = set(measures) - set(SALES_MEASURES.values())
+        if unknown or not measures:
+            raise Exception("Unknown sales measures {}, expected some of {}"
+                            .format(sorted(unknown), list(SALES_MEASURES.values())))
+
+        df = None
+        for table, measure in SALES_MEASURES.items():
+            if measure not in measures:
+                continue
+            measure_df = self._load(table, models, weeks)
+            if channel is not None:
+                measure_df = measure_df.filter(F.col('channel') == channel)
+            df = measure_df if df is None else df.join(measure_df, on=SALES_KEYS, how='inner')
+
+        if with_tree:
+            tree = self.tree(models, weeks)
+            df = df \
+                .join(tree, on=['model_id'], how='inner') \
+                .filter(F.col('week_id').between(F.col('valid_from_week'), F.col('valid_to_week'))) \
+                .drop('valid_from_week', 'valid_to_week')
+        if with_mrp:
+            df = df.join(self.mrp(models, weeks), on=['model_id', 'week_id'], how='left')
+        return df
@@ -0,0 +1,73 @@
+import json
+import pprint
+from collections import OrderedDict
+from datetime import datetime
+
+import src.tools.utils as ut
+
+
+class RunReport(object):
+    """
+    Class used to gather the technical decisions & metrics of a run and to publish them as a JSON report
+    """
+
+    def __init__(self, current_week):
+        """
+        Create an empty report for the current run
+
+        Args:
+            current_week: (int) week id the run is computed for
+        """
+        self.run_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        self._sections = OrderedDict()
+        self.add('run', 'run_id', self.run_id)
+        self.add('run', 'current_week', current_week)
+
+    def add(self, section, key, value):
+        """
+        Add (or replace) a value in a section of the report
+
+        Args:
+            section: (string) name of the section
+            key: (string) name of the value
+            value: JSON serializable value
+        """
+        self._sections.setdefault(section, OrderedDict())[key] = value
+
+    def get(self, section):
+        """
+        Get a section of the report
+
+        Args:
+            section: (string) name of the section
+
+        Returns:
+            object: (dict) the values of the section, empty if the section does not exist
+        """
+        return self._sections.get(section, OrderedDict())
+
+    def pretty_print(self):
+        """
+        Pretty prints the report
+        """
+        pprint.pprint(json.loads(self.to_json()))
+
+    def to_json(self):
+        """
+        Serialize the report
+
+        Returns:
+            object: (string) the report in JSON format
+        """
+        return json.dumps(self._sections, indent=2, default=str)
+
+    def write(self, spark, bucket, dir_path):
+        """
+        Write the report on a S3 bucket, named after the run id
+
+        Args:
+            spark: (SparkSession) spark app
+            bucket: (string) S3 bucket
+            dir_path: (string) full path to the reports directory within the S3 bucket
+        """
+        ut.spark_write_text_s3(spark, bucket, '{}{}.json'.format(dir_path, self.run_id), self.to_json())
@@ -0,0 +1,86 @@
+import json
+from urllib.request import urlopen
+
+
+# Stage metrics summed over the stages of a job group
+STAGE_METRICS = ['inputBytes', 'shuffleReadBytes', 'shuffleWriteBytes', 'memoryBytesSpilled', 'diskBytesSpilled',
+                 'executorRunTime']
+
+# Peak executor metrics (max over the stages of a job group), only available if the executor metrics are polled
+PEAK_METRICS = ['JVMHeapMemory', 'OnHeapExecutionMemory', 'OffHeapExecutionMemory']
+
+
+def get_rest_api(spark, endpoint):
+    """
+    Query the monitoring REST API of the running Spark app, served by the driver UI
+
+    Args:
+        spark: (SparkSession) spark app
+        endpoint: (string) endpoint under the application, e.g. 'jobs'
+
+    Returns:
+        object: the decoded JSON response
+    """
+    url = '{}/api/v1/applications/{}/{}'.format(spark.sparkContext.uiWebUrl, spark.sparkContext.applicationId,
+                                                 endpoint)
+    with urlopen(url, timeout=30) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def get_app_input_metrics(spark):
+    """
+    Get the volume read by the scans of the Spark app and the run time of the stages reading it
+
+    Args:
+        spark: (SparkSession) spark app
+
+    Returns:
+        object: (dict) input MB, run time in seconds & throughput of the reading stages, empty if the UI is not
+                available
+    """
+    if spark.sparkContext.uiWebUrl is None:
+        return {}
+    try:
+        stages = [stage for stage in get_rest_api(spark, 'stages') if stage.get('inputBytes', 0) > 0]
+    except Exception as e:
+        print('[spark metrics] REST API not available: {}'.format(e))
+        return {}
+
+    input_mb = sum([stage['inputBytes'] for stage in stages]) / 1024.0 ** 2
+    # Run time summed over the tasks: the throughput is per executor core
+    seconds = sum([stage.get('executorRunTime', 0) for stage in stages]) / 1000.0
+    return {'input_mb': round(input_mb, 1), 'executor_run_seconds': round(seconds, 1),
+            'throughput_mb_s_per_core': round(input_mb / seconds, 1) if seconds > 0 else None}
+
+
+def get_job_group_metrics(spark, job_group):
+    """
+    Get the I/O, shuffle & spill volumes and the peak memory of the jobs run in a job group
+    (SparkContext.setJobGroup), e.g. to compare the slices of a run
+
+    Args:
+        spark: (SparkSession) spark app
+        job_group: (string) id of the job group
+
+    Returns:
+        object: (dict) metric name -> value in MB (seconds for executorRunTime), empty if the UI is not available
+    """
+    if spark.sparkContext.uiWebUrl is None:
+        return {}
+    try:
+        jobs = get_rest_api(spark, 'jobs')
+        stage_ids = set([stage_id for job in jobs if job.get('jobGroup') == job_group for stage_id in job['stageIds']])
+        stages = [stage for stage in get_rest_api(spark, 'stages') if stage['stageId'] in stage_ids]
+    except Exception as e:
+        print('[spark metrics] REST API not available: {}'.format(e))
+        return {}
+
+    metrics = {'nb_jobs': len([job for job in jobs if job.get('jobGroup') == job_group]), 'nb_stages': len(stages)}
+    for name in STAGE_METRICS:
+        total = sum([stage.get(name, 0) for stage in stages])
+        metrics[name] = round(total / 1000.0, 1) if name == 'executorRunTime' else round(total / 1024.0 ** 2, 1)
+    for name in PEAK_METRICS:
+        peaks = [stage['peakExecutorMetrics'][name] for stage in stages
+                 if name in (stage.get('peakExecutorMetrics') or {})]
+        metrics['peak' + name] = round(max(peaks) / 1024.0 ** 2, 1) if peaks else None
+    return metrics
@@ -0,0 +1,107 @@
+# S3A committer & upload settings, the committer needs the spark-hadoop-cloud module on the classpath
+S3A_COMMITTER_CONF = [
+    ('spark.hadoop.mapreduce.outputcommitter.factory.scheme.s3a',
+     'org.apache.hadoop.fs.s3a.commit.S3ACommitterFactory'),
+    ('spark.sql.sources.commitProtocolClass', 'org.apache.spark.internal.io.cloud.PathOutputCommitProtocol'),
+    ('spark.sql.parquet.output.committer.class',
+     'org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter'),
+]
+
+
+class Storage(object):
+    """
+    Class used to build the URIs of the buckets for the configured storage backend and to record the I/O:
+        - 's3': EMRFS on AWS (default)
+        - 's3a': S3A connector, on AWS or on a S3 compatible endpoint (e.g. a local MinIO)
+        - 'file': local filesystem, each bucket being a directory under a root directory
+    """
+
+    def __init__(self, storage_params=None):
+        """
+        Args:
+            storage_params: (dict) storage parameters, None for the default EMRFS backend
+        """
+        storage_params = storage_params or {}
+        self.scheme = storage_params.get('scheme', 's3')
+        self.root = storage_params.get('root', '/tmp/buckets').rstrip('/')
+        self.s3a = storage_params.get('s3a') or {}
+        self.record_io = storage_params.get('record_io', False)
+        self.io_stats = []
+        if self.scheme not in ('s3', 's3a', 'file'):
+            raise Exception("Unknown storage scheme '{}'".format(self.scheme))
+
+    def to_uri(self, bucket, key):
+        """
+        Transforms bucket & key strings into an URI of the storage backend
+
+        Args:
+            bucket (string): name of the bucket
+            key (string): key within the bucket
+
+        Returns:
+            object (string): URI format
+        """
+        if self.scheme == 'file':
+            return 'file://{}/{}/{}'.format(self.root, bucket, key)
+        return '{}://{}/{}'.format(self.scheme, bucket, key)
+
+    def get_spark_conf(self):
+        """
+        Get the Spark configurations of the storage backend, to set before the creation of the Spark Session
+
+        Returns:
+            object: (list) a list of tuples <spark_configuration_name, value>
+        """
+        if self.scheme != 's3a':
+            return []
+        conf = [
+            ('spark.hadoop.fs.s3a.committer.name', self.s3a.get('committer', 'magic')),
+            ('spark.hadoop.fs.s3a.committer.magic.enabled', 'true'),
+            ('spark.hadoop.fs.s3a.multipart.size', str(self.s3a.get('multipart_size', '128M'))),
+            ('spark.hadoop.fs.s3a.connection.maximum', str(self.s3a.get('connection_maximum', 200))),
+            ('spark.hadoop.fs.s3a.threads.max', str(self.s3a.get('threads_max', 64))),
+        ] + S3A_COMMITTER_CONF
+        if self.s3a.get('endpoint'):
+            conf += [
+                ('spark.hadoop.fs.s3a.endpoint', self.s3a['endpoint']),
+                ('spark.hadoop.fs.s3a.path.style.access', 'true'),
+                ('spark.hadoop.fs.s3a.connection.ssl.enabled', str(self.s3a['endpoint'].startswith('https')).lower()),
+            ]
+        return conf
+
+    def record(self, operation, uri, seconds, size_bytes=None):
+        """
+        Record the duration & throughput of an I/O operation
+
+        Args:
+            operation: (string) 'read' or 'write'
+            uri: (string) URI read or written
+            seconds: (float) duration of the operation
+            size_bytes: (int) number of bytes read or written, None if unknown (no throughput then)
+        """
+        self.io_stats.append({
+            'operation': operation,
+            'uri': uri,
+            'seconds': round(seconds, 1),
+            'size_mb': round(size_bytes / 1024.0 ** 2, 1) if size_bytes is not None else None,
+            'throughput_mb_s': round(size_bytes / 1024.0 ** 2 / seconds, 1)
+            if size_bytes is not None and seconds > 0 else None,
+        })
+
+
+_storage = Storage()
+
+
+def configure(storage_params):
+    """
+    Set the storage backend used by the read & write functions of the utils
+
+    Args:
+        storage_params: (dict) storage parameters
+    """
+    global _storage
+    _storage = Storage(storage_params)
+
+
+def get_storage():
+    return _storage
@@ -2,10 +2,15 @@ import time
 from datetime import datetime, timedelta
 from functools import reduce
 
+import pyspark.sql.functions as F
+from pyspark.sql import Window
+
+import src.tools.storage as storage
+
 
 def to_uri(bucket, key):
     """
-    Transforms bucket & key strings into S3 URI
+    Transforms bucket & key strings into S3 URI (or URI of the configured storage backend)
 
     Args:
         bucket (string): name of the S3 bucket
@@ -14,7 +19,7 @@ def to_uri(bucket, key):
     Returns:
         object (string): URI format
     """
-    return 's3://{}/{}'.format(bucket, key)
+    return storage.get_storage().to_uri(bucket, key)
 
 
 def spark_read_parquet_s3(spark, bucket, path):
@@ -29,10 +34,17 @@ def spark_read_parquet_s3(spark, bucket, path):
     Returns:
         (SparkDataframe): data loaded
     """
-    return spark.read.parquet(to_uri(bucket, path))
+    start = time.time()
+    df = spark.read.parquet(to_uri(bucket, path))
+    if storage.get_storage().record_io:
+        # The scan is lazy: the duration only covers the listing & the schema inference, the volume read is in the
+        # input metrics of the Spark stages (no size listed here, it would be another listing of the table)
+        storage.get_storage().record('read', to_uri(bucket, path), time.time() - start)
+    return df
 
 
-def spark_write_parquet_s3(df, bucket, dir_path, repartition=10, mode='overwrite'):
+def spark_write_parquet_s3(df, bucket, dir_path, repartition=10, mode='overwrite', partition_by=None, sort_by=None,
+                           row_group_mb=None, range_by=None):
     """
     Write a in-memory SparkDataframe to parquet files on a S3 bucket
 
@@ -42,8 +54,30 @@ def spark_write_parquet_s3(df, bucket, dir_path, repartition=10, mode='overwrite
         dir_path (string): full path to the parquet directory within the S3 bucket
         repartition (int): number of partitions files to write
         mode (string): writing mode
+        partition_by (list): columns of the partition directories, the files of a partition value are grouped
+        sort_by (list): columns sorting the rows of each file, so that the min/max statistics of the row groups
+            let the readers skip the row groups not matching their filters on these columns
+        row_group_mb (int): size of the parquet row groups, default the parquet one (128 MB)
+        range_by (list): columns range partitioning the rows (after the partition_by ones), so that each file holds
+            a disjoint range of their values and the readers skip the files not matching their filters
     """
-    df.repartition(repartition).write.parquet(to_uri(bucket, dir_path), mode=mode)
+    start = time.time()
+    if range_by:
+        df = df.repartitionByRange(repartition, *((partition_by or []) + range_by))
+    elif partition_by:
+        df = df.repartition(repartition, *partition_by)
+    else:
+        df = df.repartition(repartition)
+    if sort_by:
+        df = df.sortWithinPartitions(*sort_by)
+    writer = df.write
+    if row_group_mb:
+        writer = writer.option('parquet.block.size', row_group_mb * 1024 ** 2)
+    writer.parquet(to_uri(bucket, dir_path), mode=mode, partitionBy=partition_by)
+    if storage.get_storage().record_io:
+        seconds = time.time() - start
+        storage.get_storage().record('write', to_uri(bucket, dir_path), seconds,
+                                     get_size_s3(df.sql_ctx.sparkSession, bucket, dir_path)[1])
 
 def spark_write_csv_s3(df, bucket, dir_path, repartition=1, mode='overwrite', header=True):
     """
@@ -56,8 +90,97 @@ def spark_write_csv_s3(df, bucket, dir_path, repartition=1, mode='overwrite', he
         repartition (int): number of partitions files to write
         mode (string): writing mode
     """
+    start = time.time()
     df.repartition(repartition).write.csv(to_uri(bucket, dir_path), mode=mode, header=True)
-    
+    if storage.get_storage().record_io:
+        seconds = time.time() - start
+        storage.get_storage().record('write', to_uri(bucket, dir_path), seconds,
+                                     get_size_s3(df.sql_ctx.sparkSession, bucket, dir_path)[1])
+
+
+def get_hadoop_path(spark, bucket, path):
+    """
+    Get the Hadoop FileSystem and Path objects of a file or directory hosted on a S3 bucket
+
+    Args:
+        spark (SparkSession): spark app
+        bucket (string): S3 bucket
+        path (string): full path to the file or directory within the S3 bucket
+
+    Returns:
+        (tuple): Hadoop FileSystem and Path java objects
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(to_uri(bucket, path))
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()), hadoop_path
+
+
+def get_size_s3(spark, bucket, path):
+    """
+    Get the number of files and the total size of a directory hosted on a S3 bucket
+
+    Args:
+        spark (SparkSession): spark app
+        bucket (string): S3 bucket
+        path (string): full path to the directory within the S3 bucket
+
+    Returns:
+        (tuple): number of files, total size in bytes
+    """
+    fs, hadoop_path = get_hadoop_path(spark, bucket, path)
+    summary = fs.getContentSummary(hadoop_path)
+    return summary.getFileCount(), summary.getLength()
+
+
+def spark_write_text_s3(spark, bucket, path, text):
+    """
+    Write a small text file (report, manifest...) on a S3 bucket from the driver
+
+    Args:
+        spark (SparkSession): spark app
+        bucket (string): S3 bucket
+        path (string): full path to the file within the S3 bucket
+        text (string): content of the file
+    """
+    spark_write_bytes_s3(spark, bucket, path, text.encode('utf-8'))
+
+
+def spark_write_bytes_s3(spark, bucket, path, data, chunk_size=8 * 1024 ** 2):
+    """
+    Write a binary file on a S3 bucket from the driver, sent to the JVM by chunks
+
+    Args:
+        spark (SparkSession): spark app
+        bucket (string): S3 bucket
+        path (string): full path to the file within the S3 bucket
+        data (bytes): content of the file
+        chunk_size (int): number of bytes sent to the JVM at once
+    """
+    fs, hadoop_path = get_hadoop_path(spark, bucket, path)
+    stream = fs.create(hadoop_path, True)
+    try:
+        for offset in range(0, len(data), chunk_size):
+            stream.write(bytearray(data[offset:offset + chunk_size]))
+    finally:
+        stream.close()
+
+
+def spark_read_text_s3(spark, bucket, path):
+    """
+    Read a small text file (report, manifest...) hosted on a S3 bucket from the driver
+
+    Args:
+        spark (SparkSession): spark app
+        bucket (string): S3 bucket
+        path (string): full path to the file within the S3 bucket
+
+    Returns:
+        (string): content of the file, None if the file does not exist
+    """
+    fs, hadoop_path = get_hadoop_path(spark, bucket, path)
+    if not fs.exists(hadoop_path):
+        return None
+    return spark.read.text(to_uri(bucket, path), wholetext=True).collect()[0][0]
+
 
 def get_timer(starting_time):
     """
@@ -79,6 +202,54 @@ def union_all(l_df):
     return reduce(lambda df1, df2: df1.union(df2.select(df1.columns)), l_df)
 
 
+def coalesce_intervals(intervals, keys, next_point):
+    """
+    Merge the overlapping [begin, end] intervals of each key into disjoint intervals [begin, end_excluded)
+    of constant status: active if at least one of the overlapping intervals is active, inactive if at least one
+    has a known status, unknown (null) if all their statuses are null, like a max of the statuses.
+    Uncovered points between two intervals stay uncovered.
+
+    Args:
+        intervals (SparkDataframe): intervals with columns keys + ['begin', 'end', 'is_active']
+        keys (list): columns identifying the timelines to merge
+        next_point (function): returns the point following a point column (e.g. next day or next week)
+
+    Returns:
+        (SparkDataframe): disjoint intervals with columns keys + ['begin', 'end_excluded', 'is_active']
+    """
+    active = F.when(F.col('is_active'), 1).otherwise(0)
+    known = F.when(F.col('is_active').isNotNull(), 1).otherwise(0)
+    events = intervals \
+        .select(*keys, F.col('begin').alias('point'), F.lit(1).alias('cover'), active.alias('active'),
+                known.alias('known')) \
+        .union(intervals.select(*keys, next_point(F.col('end')).alias('point'), F.lit(-1), -active, -known)) \
+        .groupBy(*keys, 'point') \
+        .agg(F.sum('cover').alias('cover'), F.sum('active').alias('active'), F.sum('known').alias('known'))
+
+    timeline = Window.partitionBy(*keys).orderBy('point')
+    running = timeline.rowsBetween(Window.unboundedPreceding, Window.currentRow)
+    segments = events \
+        .withColumn('cover', F.sum('cover').over(running)) \
+        .withColumn('active', F.sum('active').over(running)) \
+        .withColumn('known', F.sum('known').over(running)) \
+        .withColumn('end_excluded', F.lead('point').over(timeline)) \
+        .filter(F.col('cover') > 0) \
+        .withColumn('is_active', F.when(F.col('known') > 0, F.col('active') > 0))
+
+    # Merge the contiguous segments of same status
+    previous_end = F.lag('end_excluded').over(timeline)
+    segments = segments \
+        .withColumn('is_new', previous_end.isNull() | (previous_end != F.col('point')) |
+                    ~F.lag('is_active').over(timeline).eqNullSafe(F.col('is_active'))) \
+        .withColumn('segment_id', F.sum(F.col('is_new').cast('int')).over(running)) \
+        .groupBy(*keys, 'segment_id') \
+        .agg(F.min('point').alias('begin'),
+             F.max('end_excluded').alias('end_excluded'),
+             F.max('is_active').alias('is_active')) \
+        .drop('segment_id')
+    return segments
+
+
 def date_to_week_id(date):
     """
     Turn a date to Decathlon week id